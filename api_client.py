@@ -0,0 +1,342 @@
+#! /usr/bin/python3
+"""
+Shared http client for the iscpif APIs, with adaptive rate control
+
+ - keep-alive connection pool (requests Session)
+ - AIMD concurrency window: +1 slot per window of good responses,
+   halved on 429, 5xx, timeouts or when the latency (or the api's own
+   'took') drifts far above its baseline
+ - 429 Retry-After honored by all threads, optional max request rate
+ - retries with exponential backoff + jitter
+ - circuit breaker: after many consecutive failures no more requests
+   are sent for a cooldown (the callers wait), then a single probe
+   decides if we resume; all queries give up only if the backend stays
+   down longer than max_downtime
+"""
+__author__    = "Romain Loth"
+__copyright__ = "Copyright 2017 ISCPIF-CNRS"
+__license__   = "LGPL"
+__version__   = "1"
+__email__     = "romain.loth@iscpif.fr"
+__status__    = "dev"
+
+from sys       import stderr
+from requests  import Session, RequestException, HTTPError
+from requests.adapters import HTTPAdapter
+from threading import Condition
+from time      import sleep, time
+from random    import uniform
+
+DEFAULT_MAX_CONCURRENCY = 8
+
+PARAM_MAX_RETRIES = 5
+
+# exponential backoff between retries: ~1s, 2s, 4s... (with jitter)
+PARAM_BACKOFF_BASE = 1
+PARAM_BACKOFF_MAX = 30
+
+# seconds before a request is considered failed
+PARAM_TIMEOUT = 60
+
+# congestion: smoothed latency > factor x baseline latency
+#             (and at least min_excess seconds above it)
+PARAM_LATENCY_FACTOR = 3
+PARAM_LATENCY_MIN_EXCESS = 0.05
+PARAM_LATENCY_SMOOTHING = 0.1
+# the baseline (~min latency) slowly drifts up to follow the server
+PARAM_BASELINE_DRIFT = 1.01
+
+# circuit breaker
+PARAM_FAILURE_THRESHOLD = 10
+PARAM_COOLDOWN = 30
+PARAM_MAX_COOLDOWN = 300
+# the breaker stays open longer than this (s): we give up all the queries
+PARAM_MAX_DOWNTIME = 1800
+
+
+class CircuitOpenError(Exception):
+    "the backend has been down for too long: we don't send requests anymore"
+    pass
+
+
+class LatencyTracker:
+    "baseline (~ min) and smoothed value of a latency signal"
+    def __init__(self):
+        self.baseline = None
+        self.smoothed = None
+
+    def update(self, latency):
+        "returns True if the smoothed latency looks congested"
+        if self.baseline is None:
+            self.baseline = latency
+            self.smoothed = latency
+            return False
+        self.baseline = min(latency, self.baseline * PARAM_BASELINE_DRIFT)
+        self.smoothed += PARAM_LATENCY_SMOOTHING * (latency - self.smoothed)
+        return (self.smoothed > PARAM_LATENCY_FACTOR * self.baseline
+                and self.smoothed - self.baseline > PARAM_LATENCY_MIN_EXCESS)
+
+
+def backoff_delay(nretries):
+    "exponential backoff with jitter: half fixed, half random"
+    delay = min(PARAM_BACKOFF_MAX, PARAM_BACKOFF_BASE * 2 ** (nretries-1))
+    return delay / 2 + uniform(0, delay / 2)
+
+
+def response_took(result):
+    "the api's own processing time in seconds if the json has one"
+    if isinstance(result, dict):
+        if isinstance(result.get('took'), (int, float)):
+            return result['took'] / 1000
+        if (isinstance(result.get('results'), dict)
+            and isinstance(result['results'].get('took'), (int, float))):
+            return result['results']['took'] / 1000
+    return None
+
+
+class ApiClient:
+    """
+    Thread-safe client: call get_json() from as many threads as
+    max_concurrency, the window decides how many requests really run.
+
+    max_rate:     optional cap on requests per second (None: no cap)
+    max_downtime: seconds of open circuit breaker after which all the
+                  queries give up
+    """
+    def __init__(self, max_concurrency = DEFAULT_MAX_CONCURRENCY,
+                       max_retries = PARAM_MAX_RETRIES,
+                       max_rate = None,
+                       timeout = PARAM_TIMEOUT,
+                       user_agent = None,
+                       verbose = False,
+                       max_downtime = PARAM_MAX_DOWNTIME):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.max_rate = max_rate
+        self.timeout = timeout
+        self.max_downtime = max_downtime
+        self.verbose = verbose
+
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=self.max_concurrency,
+                              pool_maxsize=self.max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if user_agent is not None:
+            self.session.headers['User-Agent'] = user_agent
+
+        self.cond = Condition()
+
+        # AIMD window (float, we use its int part)
+        self.limit = max(1, self.max_concurrency / 2)
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.latency = LatencyTracker()
+        self.took = LatencyTracker()
+
+        # pacing
+        self.not_before = 0
+        self.next_start = 0
+
+        # circuit breaker
+        self.failures = 0
+        self.open_until = None
+        self.down_since = None
+        self.cooldown = PARAM_COOLDOWN
+        self.probing = False
+
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0,
+                      'decreases': 0, 'breaker_opens': 0}
+
+    def log(self, msg):
+        if self.verbose:
+            print(msg, file=stderr)
+
+    def acquire(self):
+        """
+        waits for a slot in the window (and the pacing)
+        returns (start time of the request, is it the half-open probe)
+
+        while the breaker is open we wait for the end of the cooldown
+        and for the probe (only it is sent), then raises CircuitOpenError
+        if the backend has been down for more than max_downtime
+        """
+        is_probe = False
+        with self.cond:
+            while True:
+                now = time()
+                if self.open_until is not None:
+                    if now - self.down_since > self.max_downtime:
+                        raise CircuitOpenError()
+                    if now < self.open_until:
+                        self.cond.wait(min(self.open_until,
+                                           self.down_since + self.max_downtime)
+                                       - now + 0.01)
+                        continue
+                    if self.probing:
+                        self.cond.wait(1)
+                        continue
+                    # half-open: this request is the probe
+                    self.probing = True
+                    is_probe = True
+                    break
+                if now < self.not_before:
+                    self.cond.wait(self.not_before - now)
+                elif self.in_flight >= int(self.limit):
+                    self.cond.wait(1)
+                else:
+                    break
+
+            self.in_flight += 1
+            self.stats['requests'] += 1
+
+            start = max(now, self.next_start)
+            if self.max_rate:
+                self.next_start = start + 1 / self.max_rate
+
+        if start > now:
+            sleep(start - now)
+        return (start, is_probe)
+
+    def decrease(self, started):
+        "multiplicative decrease, once per round of requests"
+        if started > self.last_decrease:
+            self.limit = max(1, self.limit / 2)
+            self.last_decrease = time()
+            self.stats['decreases'] += 1
+            self.log("api client: congestion, window => %i" % self.limit)
+
+    def close_circuit(self):
+        "(called with the lock held)"
+        self.open_until = None
+        self.down_since = None
+        self.failures = 0
+        self.cooldown = PARAM_COOLDOWN
+        self.log("api client: circuit closed")
+
+    def release(self, started, is_probe, outcome, latency = None,
+                      took = None, retry_after = None):
+        """
+        outcome: 'ok', 'throttled' (429), 'error' (down, timeout or 5xx)
+                 or 'bad' (other error: no effect on the rate control)
+        """
+        with self.cond:
+            self.in_flight -= 1
+            if is_probe:
+                self.probing = False
+
+            if outcome == 'ok':
+                self.failures = 0
+                if is_probe:
+                    self.close_circuit()
+                congested = False
+                if latency is not None:
+                    congested = self.latency.update(latency)
+                if took is not None:
+                    congested = self.took.update(took) or congested
+                if congested:
+                    self.decrease(started)
+                else:
+                    # additive increase: +1 per window of good responses
+                    self.limit = min(self.max_concurrency,
+                                     self.limit + 1 / self.limit)
+
+            elif outcome == 'throttled':
+                self.stats['throttled'] += 1
+                if is_probe:
+                    self.close_circuit()
+                self.decrease(started)
+                pause = retry_after if retry_after is not None else 1
+                self.not_before = max(self.not_before, time() + pause)
+
+            elif outcome == 'error':
+                self.stats['errors'] += 1
+                self.failures += 1
+                self.decrease(started)
+                if is_probe or (self.open_until is None and
+                                self.failures >= PARAM_FAILURE_THRESHOLD):
+                    self.open_until = time() + self.cooldown
+                    if self.down_since is None:
+                        self.down_since = time()
+                    self.stats['breaker_opens'] += 1
+                    print("api client: backend looks down, "
+                          "no requests for %is" % self.cooldown, file=stderr)
+                    self.cooldown = min(PARAM_MAX_COOLDOWN, self.cooldown * 2)
+
+            elif is_probe:
+                # an answer, even a bad one: the backend is up
+                self.close_circuit()
+
+            self.cond.notify_all()
+
+    def get_json(self, url, params, check = None, description = None):
+        """
+        GET url and parse the json response (with retries)
+        check(json) may raise KeyError/TypeError/ValueError to reject it
+
+        returns the json or None if we gave up
+        """
+        if description is None:
+            description = url
+
+        nretries = 0
+        while True:
+            try:
+                (started, is_probe) = self.acquire()
+            except CircuitOpenError:
+                print("GIVING UP query for %s (backend down for more than %is)"
+                      % (description, self.max_downtime), file=stderr)
+                return None
+
+            outcome = 'bad'
+            latency = None
+            took = None
+            retry_after = None
+            try:
+                resp = self.session.get(url, params=params,
+                                        timeout=self.timeout)
+                latency = resp.elapsed.total_seconds()
+                self.log('queryied url: %s' % resp.url)
+
+                if resp.status_code == 429:
+                    outcome = 'throttled'
+                    try:
+                        retry_after = float(resp.headers.get('Retry-After'))
+                    except (TypeError, ValueError):
+                        pass
+                elif resp.status_code >= 500:
+                    outcome = 'error'
+                resp.raise_for_status()
+
+                result = resp.json()
+                if check is not None:
+                    check(result)
+                outcome = 'ok'
+                took = response_took(result)
+                return result
+
+            except HTTPError as e:
+                error = e
+            except (ValueError, KeyError, TypeError) as e:
+                # (before RequestException: a non-json body raises a
+                #  JSONDecodeError, which is also a RequestException)
+                error = e
+            except RequestException as e:
+                # connection errors, timeouts...
+                outcome = 'error'
+                error = e
+            finally:
+                self.release(started, is_probe, outcome, latency, took,
+                             retry_after)
+
+            if nretries >= self.max_retries:
+                print("GIVING UP query for %s (%s)" % (description, error),
+                      file=stderr)
+                return None
+            nretries += 1
+            sleep(backoff_delay(nretries))
+            print("retrying %i query for %s" % (nretries, description),
+                  file=stderr)
+
+    def close(self):
+        self.session.close()
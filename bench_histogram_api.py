@@ -0,0 +1,256 @@
+#! /usr/bin/python3
+"""
+Load test of the histogram queries for a gexf of N nodes
+
+Runs the fetch stage of full_growth_rate_gexf_query_and_add.py (or a
+wos-like crawl) against a local mock api (cf. mock_histogram_api.py)
+or any --url, and reports requests/s, p50/p99 latency and wall time.
+"""
+__author__    = "Romain Loth"
+__copyright__ = "Copyright 2017 ISCPIF-CNRS"
+__license__   = "LGPL"
+__version__   = "1"
+__email__     = "romain.loth@iscpif.fr"
+__status__    = "dev"
+
+from argparse  import ArgumentParser
+from sys       import argv
+from os        import path
+from tempfile  import TemporaryDirectory
+from threading import Thread
+from time      import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_histogram_api import make_server
+from api_client import ApiClient
+from gexf_model import GexfGraph
+from full_growth_rate_gexf_query_and_add import (
+    DEFAULT_CONCURRENCY, fetch_all_histograms, normalize_label
+)
+
+DEFAULT_N_NODES = 1000
+
+MOCK_PATHS = {
+    'twitter': "/v2/pub/politic/france/twitter/histogram",
+    'wos': "/1/wos/search/histogram.json"
+}
+
+
+def write_synthetic_gexf(gexf_path, n_nodes, dup_every = 10):
+    """
+    a minimal gexf with n_nodes labelled nodes
+    (every dup_every node is a case variant of the previous label)
+    """
+    fh = open(gexf_path, 'w')
+    fh.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<gexf xmlns="http://www.gexf.net/1.3" version="1.3">\n'
+             '<graph defaultedgetype="undirected">\n'
+             '<attributes class="node"></attributes>\n<nodes>\n')
+    for i in range(n_nodes):
+        label = "term %05i" % i
+        if dup_every and i % dup_every == dup_every - 1:
+            label = ("term %05i" % (i-1)).upper()
+        fh.write('<node id="%i" label="%s"><attvalues></attvalues></node>\n'
+                 % (i, label))
+    fh.write('</nodes>\n<edges></edges>\n</graph>\n</gexf>\n')
+    fh.close()
+
+
+def percentile(sorted_vals, pct):
+    if not len(sorted_vals):
+        return float('nan')
+    i = min(len(sorted_vals) - 1, int(len(sorted_vals) * pct / 100))
+    return sorted_vals[i]
+
+
+def bench_twitter(labels, api_url, api_args, batch_size, client):
+    "the fetch stage of the enrichment script => (n ok, n failed)"
+    expressions = sorted(set(normalize_label(l) for l in labels))
+    n_ok = 0
+    n_failed = 0
+    for expression, result in fetch_all_histograms(
+            expressions, api_url, api_args,
+            batch_size=batch_size, client=client):
+        if result is None:
+            n_failed += 1
+        else:
+            n_ok += 1
+    return (n_ok, n_failed)
+
+
+def bench_wos(labels, api_url, client):
+    "one wos-like query per label like the crawl loop => (n ok, n failed)"
+    def check_wos(result):
+        result['aggs']['publicationCount']['buckets']
+
+    def query_one(label):
+        params = {'q[]': '"%s"' % label.lower(), 'since': 2000, 'until': 2015}
+        return client.get_json(api_url, params, check_wos,
+                               "'%s'" % label) is not None
+
+    with ThreadPoolExecutor(max_workers=client.max_concurrency) as pool:
+        results = list(pool.map(query_one, labels))
+    return (results.count(True), results.count(False))
+
+
+if __name__ == '__main__':
+    # cli args
+    # --------
+    parser = ArgumentParser(
+        description="Load test of the histogram queries for a gexf of N nodes, against a local mock api (default) or any --url",
+        epilog="-----(© 2017 ISCPIF-CNRS romain.loth at iscpif dot fr )-----")
+
+    parser.add_argument('--nodes',
+        metavar='N',
+        type=int,
+        default=DEFAULT_N_NODES,
+        help='number of nodes of the synthetic gexf (default: %i)' % DEFAULT_N_NODES,
+        required=False,
+        action='store')
+
+    parser.add_argument('--gexf',
+        metavar='pathto/graph.gexf',
+        help='use the labels of this gexf instead of a synthetic one',
+        required=False,
+        action='store')
+
+    parser.add_argument('--api',
+        choices=['twitter', 'wos'],
+        default='twitter',
+        help='response shape / query style (default: twitter)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--url',
+        metavar='http://127.0.0.1:8765/histogram',
+        help='api to test (default: a local mock api started for the test)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--concurrency',
+        metavar='8',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help='max number of simultaneous queries, adapted by the client (default: %i)' % DEFAULT_CONCURRENCY,
+        required=False,
+        action='store')
+
+    parser.add_argument('--maxRate',
+        metavar='req/s',
+        type=float,
+        default=None,
+        help='max number of queries per second (default: no limit)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--batchSize',
+        metavar='1',
+        type=int,
+        default=1,
+        help='labels per query (twitter api only, cf. full_growth_rate_gexf_query_and_add.py)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--apiInterval',
+        metavar='day',
+        default='day',
+        help='interval param for the twitter api',
+        required=False,
+        action='store')
+
+    # mock options
+    parser.add_argument('--latency',
+        metavar='ms',
+        type=float,
+        default=20,
+        help='local mock: fixed part of the response time (default: 20)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--jitter',
+        metavar='ms',
+        type=float,
+        default=10,
+        help='local mock: random part of the response time (default: 10)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--errorRate',
+        metavar='0.01',
+        type=float,
+        default=0,
+        help='local mock: fraction of HTTP 500 responses',
+        required=False,
+        action='store')
+
+    parser.add_argument('--rateLimit',
+        metavar='req/s',
+        type=float,
+        default=0,
+        help='local mock: max requests per second (default: no limit)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--splitBatches',
+        default=False,
+        help='local mock: separate results per term for multi-term queries',
+        required=False,
+        action='store_true')
+
+    args = parser.parse_args(argv[1:])
+
+    # local mock api
+    server = None
+    api_url = args.url
+    if api_url is None:
+        server = make_server(0, latency=args.latency, jitter=args.jitter,
+                             error_rate=args.errorRate,
+                             rate_limit=args.rateLimit,
+                             split_batches=args.splitBatches)
+        Thread(target=server.serve_forever, daemon=True).start()
+        api_url = "http://127.0.0.1:%i%s" % (server.server_address[1],
+                                            MOCK_PATHS[args.api])
+
+    # the session records the latency of each response (retries included)
+    latencies = []
+    client = ApiClient(args.concurrency, max_rate=args.maxRate)
+    client.session.hooks['response'].append(
+        lambda resp, *a, **kw: latencies.append(resp.elapsed.total_seconds()))
+
+    with TemporaryDirectory() as tmp_dir:
+        gexf_path = args.gexf
+        if gexf_path is None:
+            gexf_path = path.join(tmp_dir, "bench_%i.gexf" % args.nodes)
+            write_synthetic_gexf(gexf_path, args.nodes)
+
+        t0 = time()
+
+        # like in the enrichment script
+        graph = GexfGraph(gexf_path, attr_names=[])
+        labels = [label for label in graph.labels if label]
+
+        if args.api == 'twitter':
+            (n_ok, n_failed) = bench_twitter(labels, api_url,
+                                             {'interval': args.apiInterval},
+                                             args.batchSize, client)
+        else:
+            (n_ok, n_failed) = bench_wos(labels, api_url, client)
+
+        wall_time = time() - t0
+
+    client.close()
+
+    latencies.sort()
+    print("url:         %s" % api_url)
+    print("nodes:       %i" % len(labels))
+    print("queries ok:  %i (failed: %i)" % (n_ok, n_failed))
+    print("requests:    %i" % len(latencies))
+    print("wall time:   %.2f s" % wall_time)
+    print("requests/s:  %.1f" % (len(latencies) / wall_time))
+    print("latency p50: %.1f ms" % (percentile(latencies, 50) * 1000))
+    print("latency p99: %.1f ms" % (percentile(latencies, 99) * 1000))
+    print("client:      %s (final window: %i)"
+            % (client.stats, client.limit))
+    if server is not None:
+        print("mock stats:  %s" % server.stats)
+        server.shutdown()
@@ -1,71 +1,127 @@
 #! /usr/bin/python3
 """
-Read a gexf and query each node label with an API to create a new node attribute (ex: growth_rate) in the gexf
+Copy node attributes (one, a list or all of them) from a source gexf
+to one or several target gexf, matching the nodes by id, label or
+normalized label
+
+The source is read once into an index {key: {attr: value}}, then
+each target is rewritten in one streaming pass (cf. gexf_model.py)
 """
 __author__    = "Romain Loth"
 __copyright__ = "Copyright 2017 ISCPIF-CNRS"
 __license__   = "LGPL"
-__version__   = "1"
+__version__   = "2"
 __email__     = "romain.loth@iscpif.fr"
 __status__    = "dev"
 
 from argparse  import ArgumentParser
-from sys       import argv, stderr
-from lxml      import etree
-from re        import sub, search
-from os        import path
-from requests  import get
-from time      import sleep
+from sys       import argv, stderr, stdout
+from os        import path, replace
+from unicodedata import normalize, combining
 
-# prepare corresponding namespace
-MY_NS = {"g":"http://www.gexf.net/1.3"}
+from gexf_add_attr import normalize_attr_name
+from gexf_model import (
+    GexfGraph, attvalues_index, upsert_node_attvalue, stream_rewrite_gexf
+)
+
+
+def normalized_label(label):
+    "lowercase, without accents and single spaced"
+    label = ''.join(c for c in normalize('NFKD', label.lower())
+                      if not combining(c))
+    return ' '.join(label.split())
+
+
+def id_key(nodeid, label):
+    return nodeid
+
+
+def label_key(nodeid, label):
+    return label
 
-def add_attr_declaration(xml_tree, attr_name, format = 'float'):
-    """
-    for output       NB assumes there already is an <attributes> element
-    (modifies the tree in-place)
-    """
-    attrs_declaration = xml_tree.xpath(
-        '/g:gexf/g:graph/g:attributes[@class="node"]',
-        namespaces=MY_NS).pop()
-    new_attr_declaration = etree.Element("attribute")
-    new_attr_declaration.attrib['id']    = attr_name
-    new_attr_declaration.attrib['title'] = attr_name
-    new_attr_declaration.attrib['type']  = format
-    attrs_declaration.append(new_attr_declaration)
 
+def normalized_label_key(nodeid, label):
+    return normalized_label(label) if label is not None else None
 
-def insert_attribute(xml_node, attr_name, attr_val):
+
+# how we match the source and target nodes
+JOIN_KEYS = {
+    'id': id_key,
+    'label': label_key,
+    'normalized-label': normalized_label_key
+}
+
+
+def read_source_attributes(gexf_path, attr_names = None, join_key = id_key):
     """
-    for output
-    (modifies the node in-place)
-    insert into one gexf:node
+    One pass on the source gexf (cf. gexf_model.GexfGraph, with the values
+    kept as their gexf text)
+
+    attr_names: the attributes to copy (by id or title), None for all
+    join_key:   (nodeid, label) => key for the index (cf. JOIN_KEYS)
+
+    returns (declarations, copied_vals, ambiguous)
+      - declarations: [(attr_id, type, title)...] in the source order
+      - copied_vals: {key: {attr_id: value}}
+      - ambiguous: the keys shared by source nodes with different values
+                   (in copied_vals they keep the values of the first node
+                    in the document order)
     """
-    current_attrs = xml_node.xpath('g:attvalues', namespaces=MY_NS).pop()
+    source = GexfGraph(gexf_path, attr_names, typed=False)
+    declarations = [(attr_id, attr_type, title)
+                    for attr_id, (attr_type, title)
+                    in source.declarations.items()]
+    copied_vals = {}
+    ambiguous = set()
 
-    # the fragment to add
-    # -------------------
-    # ex: <attvalue for="bidule" value="5.32">
-    new_attr = etree.Element("attvalue")
-    new_attr.attrib['for'] = attr_name
-    new_attr.attrib['value'] = str(attr_val)
+    for row in range(len(source)):
+        key = join_key(source.ids[row], source.labels[row])
+        if key is None:
+            continue
+        node_vals = source.node_values(row)
+        if len(node_vals):
+            if key not in copied_vals:
+                copied_vals[key] = node_vals
+            elif copied_vals[key] != node_vals:
+                ambiguous.add(key)
 
-    # add in this node
-    current_attrs.append(new_attr)
+    return (declarations, copied_vals, ambiguous)
 
 
-if __name__ == '__main__':
+def copy_to_target(tgt_path, out_fh, declarations, copied_vals,
+                   join_key = id_key, ambiguous = set()):
+    """
+    Streams a target gexf to out_fh with the copied attributes
 
-    # values to copy, by node id
-    copied_vals = {}
+    returns stats {'matched': n, 'ambiguous': n, 'missing': n,
+                   'added': n, 'updated': n, 'unchanged': n} where
+    ambiguous counts the matched target nodes with an ambiguous key
+    and added/updated/unchanged count the attvalues
+    """
+    stats = {'matched': 0, 'ambiguous': 0, 'missing': 0,
+             'added': 0, 'updated': 0, 'unchanged': 0}
+    def add_copied_values(node):
+        key = join_key(node.get('id'), node.get('label'))
+        node_vals = copied_vals.get(key)
+        if node_vals is None:
+            stats['missing'] += 1
+            return
+        stats['matched'] += 1
+        if key in ambiguous:
+            stats['ambiguous'] += 1
+        index = attvalues_index(node)
+        for attr_id, value in node_vals.items():
+            stats[upsert_node_attvalue(node, attr_id, value, index)] += 1
+
+    stream_rewrite_gexf(tgt_path, out_fh, declarations, add_copied_values)
+    return stats
 
-    # declared format ('int', etc)
-    copied_format = None
 
+if __name__ == '__main__':
     # cli args
     # --------
     parser = ArgumentParser(
-        description="Read a gexf and query each node label with an API to create a new node attribute (ex: growth_rate) in the gexf",
+        description="Copy node attributes (one, a list or all) from a source gexf to one or several target gexf, matching the nodes by id or label",
         epilog="-----(© 2017 ISCPIF-CNRS romain.loth at iscpif dot fr )-----")
 
     parser.add_argument('--gexfsrc',
@@ -76,70 +132,91 @@ if __name__ == '__main__':
 
     parser.add_argument('--gexftgt',
         metavar='pathto/graph2.gexf',
-        help='graph into which we merge the values and send, modified, to STDOUT',
+        nargs='+',
+        help='graph(s) into which we merge the values: one is sent, modified, to STDOUT (several need --outdir)',
         required=True,
         action='store')
 
-    parser.add_argument('--attr',
+    attr_choice = parser.add_mutually_exclusive_group(required=True)
+
+    attr_choice.add_argument('--attr',
         metavar='attr_name',
-        help='name of the attribute to copy',
-        required=True,
+        help='name of the attribute to copy (or a comma-separated list)',
         action='store')
 
-    args = parser.parse_args(argv[1:])
-
-    if args.attr:
-        # normalize name of the new attribute
-        new_attr_name = sub(r'\W+', '_', args.attr)
-        new_attr_name = sub(r'^_+', '', new_attr_name)
-        new_attr_name = sub(r'_+$', '', new_attr_name)
+    attr_choice.add_argument('--all',
+        default=False,
+        help='copy all the node attributes of the source',
+        action='store_true')
 
-    # read input xml graph
-    xml_src_tree = etree.parse(args.gexfsrc)
-
-    # get all source nodes by xpath
-    source_nodes = xml_src_tree.xpath('/g:gexf/g:graph/g:nodes/g:node', namespaces=MY_NS)
-
-    # store the declared format
-    try:
-        copied_format = xml_src_tree.xpath('/g:gexf/g:graph/g:attributes[@class="node"]/g:attribute[@title="%s"]/@type' % new_attr_name, namespaces=MY_NS).pop()
-    except:
-        copied_format = 'string'
-
-    # READ graph 1 "src"
-    for node in source_nodes:
-        if ('id' in node.attrib):
-            current_attr_elts = node.xpath('g:attvalues/g:attvalue[@for="%s"]' % new_attr_name, namespaces=MY_NS)
-            if len(current_attr_elts) == 1:
-                the_value = current_attr_elts[0].attrib['value']
-
-                # store it
-                copied_vals[node.attrib['id']] = the_value
+    parser.add_argument('--outdir',
+        metavar='pathto/outdir',
+        help='write each modified target to this dir (same file name) instead of STDOUT',
+        required=False,
+        action='store')
 
+    parser.add_argument('--join-on',
+        choices=list(JOIN_KEYS),
+        default='id',
+        help='how to match the source and target nodes: same id (default), same label, or same label once lowercased, without accents and single spaced',
+        required=False,
+        action='store')
 
-    # ---------------------------------
-    # now, let's modify all target nodes
+    parser.add_argument('--skip-ambiguous',
+        default=False,
+        help='don\'t copy anything for the keys that several source nodes share with different values (default: the first of them in the source wins)',
+        required=False,
+        action='store_true')
 
-    # read target xml graph
-    xml_tgt_tree = etree.parse(args.gexftgt)
+    args = parser.parse_args(argv[1:])
 
-    # WRITE OUTPUT
-    # 1 - add once the attribute declaration
-    add_attr_declaration(xml_tgt_tree, new_attr_name, copied_format)
+    if len(args.gexftgt) > 1 and not args.outdir:
+        print("ERR: several --gexftgt need an --outdir", file=stderr)
+        exit(1)
 
-    # 2 - insert computed value in each nodes' xml
-    target_nodes = xml_tgt_tree.xpath('/g:gexf/g:graph/g:nodes/g:node', namespaces=MY_NS)
+    if args.attr:
+        # normalize names of the copied attributes
+        attr_names = {normalize_attr_name(a) for a in args.attr.split(',')}
+    else:
+        attr_names = None
 
-    stat_n_missing_ids = 0
-    for node in target_nodes:
-        if ('id' in node.attrib):
-            if (node.attrib['id'] in copied_vals):
-                the_stored_value = copied_vals[node.attrib['id']]
-                insert_attribute(node, new_attr_name, the_stored_value)
-            else:
-                stat_n_missing_ids += 1
+    join_key = JOIN_KEYS[args.join_on]
 
-    print('Missing ids: %i' % stat_n_missing_ids, file=stderr)
+    # READ graph 1 "src"
+    (declarations, copied_vals, ambiguous) = read_source_attributes(
+                                        args.gexfsrc, attr_names, join_key)
+    print('Copying %i attribute(s) (%s) for %i source keys (%s), '
+          '%i ambiguous keys'
+          % (len(declarations), ", ".join(d[0] for d in declarations),
+             len(copied_vals), args.join_on, len(ambiguous)), file=stderr)
+
+    if args.skip_ambiguous:
+        for key in ambiguous:
+            del copied_vals[key]
+        ambiguous = set()
 
-    # print resulting XML to STDOUT
-    print(etree.tostring(xml_tgt_tree, pretty_print=True).decode('UTF-8'))
+    # ---------------------------------
+    # now, let's stream all target graphs
+    for tgt_path in args.gexftgt:
+        if args.outdir:
+            out_path = path.join(args.outdir, path.basename(tgt_path))
+            if path.realpath(out_path) == path.realpath(tgt_path):
+                print("ERR: skip %s (--outdir would overwrite it)" % tgt_path,
+                      file=stderr)
+                continue
+            tmp_path = out_path + '.tmp'
+            with open(tmp_path, 'wb') as out_fh:
+                stats = copy_to_target(tgt_path, out_fh, declarations,
+                                       copied_vals, join_key, ambiguous)
+            replace(tmp_path, out_path)
+        else:
+            # print resulting XML to STDOUT
+            stats = copy_to_target(tgt_path, stdout.buffer, declarations,
+                                   copied_vals, join_key, ambiguous)
+
+        print('%s: matched nodes: %i (ambiguous: %i), missing %s: %i'
+              % (tgt_path, stats['matched'], stats['ambiguous'],
+                 args.join_on, stats['missing']), file=stderr)
+        print('%s: values added: %i, updated: %i, unchanged: %i'
+              % (tgt_path, stats['added'], stats['updated'],
+                 stats['unchanged']), file=stderr)
@@ -4,7 +4,8 @@ Filters an ES terms aggregation (JSON) on an external list of terms
 
 The filtering master list can be retrieved from a directory of gexf files or provided as a one per line txt doc.
 
-TODO aggregate k weeks in a time bucket
+The weekly time buckets can also be aggregated by k weeks or by calendar
+month, quarter or year.
 """
 __author__    = "Romain Loth"
 __copyright__ = "Copyright 2016 ISCPIF-CNRS"
@@ -15,36 +16,167 @@ __status__    = "dev"
 
 
 from argparse import ArgumentParser
-from sys      import argv, stderr
+from sys      import argv, stderr, stdout
 from json     import load, dumps
 from glob     import glob
 from lxml     import etree
+from multiprocessing import Pool
+from hashlib  import sha1
+from os       import path, stat, replace, remove
+from datetime import datetime
+from calendar import timegm
+from collections import deque
+from functools import lru_cache
+from unicodedata import normalize, combining
+
+from gexf_model import iter_node_labels
 
 DEFAULT_MASTER_GEXF_DIR="/var/www/COP21/data/ClimateChange"
 DEFAULT_INPUT_JSON_PATH="Climate_Change_Weekly_new.json"
+DEFAULT_LABELS_INDEX_PATH="gexf_labels_index.json"
 
 def retrieve_gexf_node_labels(my_path):
-    "mypath points to a gexf XML file"
+    """
+    mypath points to a gexf XML file
 
-    # parse gexf
+    The labels are read by gexf_model.iter_node_labels (streaming, each
+    node freed after its label, stops at the end of the top-level <nodes>)
+    (returns the set of labels, or None if the file can't be parsed)
+    """
     try:
-        gexfdom = etree.parse(my_path)
+        return {label for label in iter_node_labels(my_path)
+                      if label is not None}
+
     except etree.XMLSyntaxError as e:
         print("gexf xml input error: %s %s (skip)"
                     % (my_path, e),
                     file=stderr)
-        return []
-
-    # xpath
-    my_xpath_elts = ['gexf','graph','nodes','node']
-    nsfree_path = "".join(
-                ["/*[local-name()=\"%s\"]" % elt for elt in my_xpath_elts]
-            )
-    all_labels = gexfdom.xpath(nsfree_path+'/@label')
-
-    # print(nsfree_path+'/@label', file=stderr)
-
-    return all_labels
+        return None
+
+def gexf_file_hash(my_path):
+    "sha1 of the file contents (read by 1MB chunks)"
+    sha = sha1()
+    fh = open(my_path, 'rb')
+    for chunk in iter(lambda: fh.read(1<<20), b''):
+        sha.update(chunk)
+    fh.close()
+    return sha.hexdigest()
+
+def harvest_gexf_file(my_path):
+    """
+    worker for the process pool: labels + content hash for the index
+    (or (None, None) if the gexf can't be parsed)
+    """
+    labels = retrieve_gexf_node_labels(my_path)
+    if labels is None:
+        return (None, None)
+    return (labels, gexf_file_hash(my_path))
+
+def read_labels_index(index_path):
+    """
+    The labels index is a json file with the labels already harvested
+    from each gexf, stored under its absolute path with its fingerprint
+     ex: {"/data/a.gexf": {"mtime":..., "size":..., "sha1":..., "labels":[...]}}
+    """
+    if not path.exists(index_path):
+        return {}
+    try:
+        fh = open(index_path, 'r')
+        index = load(fh)
+        fh.close()
+    except ValueError as e:
+        print("labels index error: %s %s (ignored)" % (index_path, e),
+              file=stderr)
+        return {}
+    return index
+
+def write_labels_index(index, index_path):
+    """
+    atomic write (tmp file + rename) and we forget the deleted gexfs
+
+    (an unwritable index is only a warning: we just go on without cache)
+    """
+    index = {p: entry for p, entry in index.items() if path.exists(p)}
+    tmp_path = index_path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as fh:
+            fh.write(dumps(index))
+        replace(tmp_path, index_path)
+    except OSError as e:
+        print("labels index error: can't write %s (%s), not saved"
+              % (index_path, e), file=stderr)
+        try:
+            remove(tmp_path)
+        except OSError:
+            pass
+
+def lookup_labels_index(index, abs_path):
+    """
+    Returns the indexed labels of a gexf if it didn't change, otherwise None
+
+    Same mtime and size => unchanged (no need to read the file)
+    Same size but other mtime => unchanged only if same content hash
+    (updates the index entry in-place when only the mtime moved)
+    """
+    if abs_path not in index:
+        return None
+    entry = index[abs_path]
+    st = stat(abs_path)
+
+    if st.st_size != entry['size']:
+        return None
+    elif st.st_mtime != entry['mtime']:
+        if gexf_file_hash(abs_path) != entry['sha1']:
+            return None
+        entry['mtime'] = st.st_mtime
+
+    return entry['labels']
+
+def retrieve_all_gexf_node_labels(gexf_paths, n_workers=None, index=None):
+    """
+    Runs retrieve_gexf_node_labels over a process pool
+
+    If an index dict is given (cf. read_labels_index), the unchanged gexf
+    are served from it, only the new or modified ones are parsed, and the
+    index is updated in-place (without the gexf that can't be parsed:
+    they're tried again, and reported, at each run).
+
+    yields (gexf_path, labels, from_index) in the same order as gexf_paths
+    """
+    if index is None:
+        index = {}
+
+    labels_per_path = {}
+    to_parse = []
+    for gexf_path in gexf_paths:
+        indexed_labels = lookup_labels_index(index, path.abspath(gexf_path))
+        if indexed_labels is None:
+            to_parse.append(gexf_path)
+        else:
+            labels_per_path[gexf_path] = indexed_labels
+
+    if len(to_parse):
+        # fingerprints before the parsing (a file modified meanwhile
+        # will just be seen as modified again at next run)
+        stats = {p: stat(p) for p in to_parse}
+        with Pool(n_workers) as pool:
+            all_results = pool.imap(harvest_gexf_file, to_parse)
+            for gexf_path, (node_labels, sha) in zip(to_parse, all_results):
+                if node_labels is None:
+                    labels_per_path[gexf_path] = set()
+                    index.pop(path.abspath(gexf_path), None)
+                    continue
+                labels_per_path[gexf_path] = node_labels
+                index[path.abspath(gexf_path)] = {
+                    'mtime': stats[gexf_path].st_mtime,
+                    'size': stats[gexf_path].st_size,
+                    'sha1': sha,
+                    'labels': sorted(node_labels)
+                }
+
+    for gexf_path in gexf_paths:
+        from_index = gexf_path not in to_parse
+        yield (gexf_path, labels_per_path[gexf_path], from_index)
 
 def read_master_list(my_path):
     "one term per line"
@@ -63,6 +195,274 @@ def add_list_to_dict(a_list, previous_dict = {}):
         previous_dict[term] = True
     return previous_dict
 
+NORMALIZATIONS = ['case', 'accents', 'spaces', 'plurals']
+
+MATCHER_CACHE_SIZE = 1<<18
+
+class PhraseAutomaton:
+    """
+    Aho-Corasick automaton on word tokens
+
+    Finds in one scan of a tokenized string if any of the phrases
+    appears in it (aligned on word boundaries).
+    """
+    def __init__(self, phrases):
+        # state 0 is the root
+        self.goto = [{}]
+        self.fail = [0]
+        self.out  = [False]
+
+        # trie
+        for phrase in phrases:
+            state = 0
+            for token in phrase.split():
+                if token not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(False)
+                    self.goto[state][token] = len(self.goto) - 1
+                state = self.goto[state][token]
+            if state:
+                self.out[state] = True
+
+        # failure links (breadth first)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(token, 0)
+                # a match ends here if a match ends at its suffix
+                self.out[next_state] = (self.out[next_state]
+                                        or self.out[self.fail[next_state]])
+
+    def contains_any(self, tokens):
+        "True if one of the phrases is a subsequence of adjacent tokens"
+        state = 0
+        for token in tokens:
+            while state and token not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(token, 0)
+            if self.out[state]:
+                return True
+        return False
+
+class TermMatcher:
+    """
+    The master terms, for the filtering (ex: `"some term" in matcher`)
+
+    normalizations: subset of NORMALIZATIONS applied to both the master
+                    terms (precomputed once) and the tested terms
+    phrases:        also accept the terms that contain a master term as a
+                    phrase (ex: "carbon tax" => "global carbon tax reform")
+    """
+    def __init__(self, terms, normalizations=(), phrases=False):
+        self.normalizations = [n for n in NORMALIZATIONS
+                                 if n in normalizations]
+        self.terms = set(self.normalize(term) for term in terms)
+        self.terms.discard('')
+
+        self.automaton = None
+        if phrases:
+            self.automaton = PhraseAutomaton(self.terms)
+
+        # the same keywords come back in every time bucket
+        self.match = lru_cache(maxsize=MATCHER_CACHE_SIZE)(self._match)
+
+    def normalize(self, term):
+        if 'case' in self.normalizations:
+            term = term.lower()
+        if 'accents' in self.normalizations:
+            term = ''.join(c for c in normalize('NFKD', term)
+                             if not combining(c))
+        if 'spaces' in self.normalizations:
+            term = ' '.join(term.split())
+        if 'plurals' in self.normalizations:
+            term = ' '.join(fold_plural(token) for token in term.split(' '))
+        return term
+
+    def _match(self, term):
+        norm_term = self.normalize(term)
+        if norm_term in self.terms:
+            return True
+        elif self.automaton is not None:
+            return self.automaton.contains_any(norm_term.split())
+        else:
+            return False
+
+    def __contains__(self, term):
+        return self.match(term)
+
+    def __len__(self):
+        return len(self.terms)
+
+def fold_plural(token):
+    "naive english plural folding: policies => policy, taxes => tax, ..."
+    if len(token) > 4 and token.endswith('ies'):
+        return token[:-3] + 'y'
+    elif len(token) > 4 and token.endswith(('xes', 'ches', 'shes', 'sses')):
+        return token[:-2]
+    elif len(token) > 3 and token.endswith('s') and token[-2] not in 'su':
+        return token[:-1]
+    else:
+        return token
+
+def filter_time_bucket(time_bucket, filter_dict, count):
+    """
+    Filters the keywords of one ES time bucket on filter_dict
+
+    returns a new TimeBucket (and updates the count dict in-place)
+    """
+    count['t_buckets'] += 1
+
+    # initialize our copy
+    tb_copy = TimeBucket(
+            time_bucket['key_as_string'],
+            time_bucket['key']
+        )
+
+    # now the keywords
+    for kw in time_bucket['keywords']['buckets']:
+        count['kw_buckets_in'] += 1
+
+        # print(kw)
+        this_term = kw['key']
+
+        # the filtering ------------
+        if this_term in filter_dict:
+            # the keeping
+            this_count = kw['doc_count']
+            tb_copy.kws.append(
+                {
+                    'key': this_term,
+                    'doc_count': this_count
+                }
+            )
+            # we add to new total
+            tb_copy.dc += this_count
+
+            # and keep track
+            count['kw_buckets_out'] += 1
+
+    return tb_copy
+
+def merge_k_group(k):
+    "group_of function for merge_time_buckets: k consecutive buckets"
+    def group_of(i, time_bucket):
+        # key and key_as_string will be those of the 1st bucket of the group
+        return (i // k, None, None)
+    return group_of
+
+def calendar_group(unit):
+    """
+    group_of function for merge_time_buckets: calendar-aligned periods
+    (unit in 'month', 'quarter', 'year')
+
+    each time bucket goes to the period of its start date (ES 'key' in ms)
+    """
+    def group_of(i, time_bucket):
+        date = datetime.utcfromtimestamp(time_bucket.k / 1000)
+        if unit == 'month':
+            start = datetime(date.year, date.month, 1)
+        elif unit == 'quarter':
+            start = datetime(date.year, 3 * ((date.month - 1) // 3) + 1, 1)
+        else:
+            start = datetime(date.year, 1, 1)
+        return (start,
+                timegm(start.timetuple()) * 1000,
+                start.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+    return group_of
+
+MERGE_UNITS = ['month', 'quarter', 'year']
+
+def merge_time_buckets(time_buckets, group_of):
+    """
+    Folds consecutive TimeBuckets into wider TimeBuckets
+
+    group_of(i, time_bucket) => (group_id, key, key_as_string)
+       - consecutive buckets with the same group_id are merged
+       - key/key_as_string None => we keep those of the 1st bucket
+
+    The keyword doc_counts are summed in a {term: count} dict for the
+    whole group, and the merged keywords are sorted by decreasing
+    doc_count like in ES.
+
+    (generator: needs only one group in memory at a time)
+    """
+    merged = None
+    merged_group = None
+    kw_counts = {}
+
+    for i, time_bucket in enumerate(time_buckets):
+        (group_id, key, key_as_string) = group_of(i, time_bucket)
+
+        if merged is None or group_id != merged_group:
+            if merged is not None:
+                merged.set_kw_counts(kw_counts)
+                yield merged
+
+            # new wider bucket
+            if key is None:
+                key = time_bucket.k
+                key_as_string = time_bucket.kas
+            merged = TimeBucket(key_as_string, key)
+            merged_group = group_id
+            kw_counts = {}
+
+        merged.dc += time_bucket.dc
+        for kw in time_bucket.kws:
+            if kw['key'] in kw_counts:
+                kw_counts[kw['key']] += kw['doc_count']
+            else:
+                kw_counts[kw['key']] = kw['doc_count']
+
+    if merged is not None:
+        merged.set_kw_counts(kw_counts)
+        yield merged
+
+def stream_filtered_json(aggs_path, filter_dict, count, out_fh, group_of=None):
+    """
+    Constant-memory variant of the main loop: the input is read with an
+    incremental JSON parser (ijson), one time bucket at a time, and each
+    filtered bucket is written to out_fh as soon as it's done.
+
+    The output has the same structure as the non-streaming mode.
+    (with group_of, the buckets are also merged cf. merge_time_buckets)
+    """
+    # optional dependency: only needed for this mode
+    import ijson
+
+    # 1st pass: the 'hits' property (comes first in ES responses => cheap)
+    aggs_f = open(aggs_path, 'rb')
+    hits = next(ijson.items(aggs_f, 'hits', use_float=True), {})
+    aggs_f.close()
+
+    out_fh.write('{"hits": %s,\n "aggregations": {"weekly": {"buckets": [\n'
+                 % dumps(hits))
+
+    # 2nd pass: the time buckets
+    aggs_f = open(aggs_path, 'rb')
+    time_buckets = ijson.items(aggs_f,
+                               'aggregations.weekly.buckets.item',
+                               use_float=True)
+    filtered_buckets = (filter_time_bucket(time_bucket, filter_dict, count)
+                            for time_bucket in time_buckets)
+    if group_of is not None:
+        filtered_buckets = merge_time_buckets(filtered_buckets, group_of)
+
+    for i, tb_copy in enumerate(filtered_buckets):
+        if i > 0:
+            out_fh.write(',\n')
+        out_fh.write(dumps(tb_copy.as_dict()))
+        out_fh.flush()
+    aggs_f.close()
+
+    out_fh.write('\n]}}}\n')
+    out_fh.flush()
+
 class TimeBucket:
     "Contains the same properties as an ES timeline bucket object"
     def __init__(self, key_as_string, key):
@@ -75,6 +475,13 @@ class TimeBucket:
         # for keyword buckets
         self.kws = []
 
+    def set_kw_counts(self, kw_counts):
+        "{term: doc_count} => keyword buckets sorted by decreasing doc_count"
+        self.kws = [
+            {'key': term, 'doc_count': kw_counts[term]}
+            for term in sorted(kw_counts, key=lambda t: -kw_counts[t])
+        ]
+
     def as_dict(self):
         "dict for json serialization"
         return {
@@ -115,8 +522,75 @@ if __name__ == '__main__':
         required=False,
         action='store')
 
+    parser.add_argument('-j',
+        metavar='n_workers',
+        help='number of parallel processes to read the gexf files with -d (default: as many as CPUs)',
+        type=int,
+        default=None,
+        required=False,
+        action='store')
+
+    parser.add_argument('--index',
+        metavar='pathto/index.json',
+        help='cache of the labels already harvested with -d: only the new or modified gexf files are parsed again (default: %s)' % DEFAULT_LABELS_INDEX_PATH,
+        default=DEFAULT_LABELS_INDEX_PATH,
+        required=False,
+        action='store')
+
+    parser.add_argument('--no-index',
+        dest='no_index',
+        help='don\'t read nor write the labels index',
+        default=False,
+        required=False,
+        action='store_true')
+
+    parser.add_argument('--stream',
+        help='constant-memory mode: read the input json incrementally (needs the ijson module) and write each filtered time bucket to STDOUT as soon as it is ready',
+        default=False,
+        required=False,
+        action='store_true')
+
+    parser.add_argument('--norm',
+        metavar='case,accents,spaces,plurals',
+        help='normalizations applied to the master terms and to the filtered terms before comparing them (comma-separated, default: none, ie exact match)',
+        default='',
+        required=False,
+        action='store')
+
+    parser.add_argument('--phrases',
+        help='also keep the keywords that contain a master term as a phrase (ex: "carbon tax" => "global carbon tax reform")',
+        default=False,
+        required=False,
+        action='store_true')
+
+    parser.add_argument('--merge-k',
+        dest='merge_k',
+        metavar='N',
+        help='aggregate the filtered weekly buckets by N consecutive weeks',
+        type=int,
+        default=None,
+        required=False,
+        action='store')
+
+    parser.add_argument('--merge-by',
+        dest='merge_by',
+        choices=MERGE_UNITS,
+        help='aggregate the filtered weekly buckets by calendar month, quarter or year (alternative to --merge-k)',
+        default=None,
+        required=False,
+        action='store')
+
     args = parser.parse_args(argv[1:])
 
+    for norm in args.norm.split(','):
+        if len(norm) and norm not in NORMALIZATIONS:
+            parser.error("unknown normalization '%s' (possible choices: %s)"
+                            % (norm, ",".join(NORMALIZATIONS)))
+    if args.merge_k is not None and args.merge_by is not None:
+        parser.error("--merge-k and --merge-by are mutually exclusive")
+    if args.merge_k is not None and args.merge_k < 1:
+        parser.error("--merge-k must be >= 1")
+
 
     # MAIN
     # ----
@@ -125,7 +599,7 @@ if __name__ == '__main__':
     filter_dict = {}
 
     if args.l:
-        filter_dict = read_master_list(args.l)
+        filter_dict = add_list_to_dict(read_master_list(args.l), filter_dict)
     else:
         gexf_paths = glob(args.d+"/*.gexf")
         if not len(gexf_paths):
@@ -134,9 +608,13 @@ if __name__ == '__main__':
                     file=stderr)
             exit(1)
         else:
-            for gexf_path in gexf_paths:
-                # grep our labels in the xml
-                node_labels = retrieve_gexf_node_labels(gexf_path)
+            labels_index = None
+            if not args.no_index:
+                labels_index = read_labels_index(args.index)
+
+            # grep our labels in the xml (in parallel) or in the index
+            for gexf_path, node_labels, from_index in \
+                retrieve_all_gexf_node_labels(gexf_paths,args.j,labels_index):
 
                 # fyi
                 n = len(node_labels)
@@ -144,16 +622,52 @@ if __name__ == '__main__':
                 # update our dict
                 filter_dict = add_list_to_dict(node_labels, filter_dict)
 
-                print("found %i labels in gexf file '%s'"
-                        % (n, gexf_path),
+                print("found %i labels in gexf file '%s'%s"
+                        % (n, gexf_path, " (index)" if from_index else ""),
                         file = stderr
                     )
 
+            if labels_index is not None:
+                write_labels_index(labels_index, args.index)
+
+    # precompute once the normalized forms (and the phrases automaton)
+    filter_dict = TermMatcher(filter_dict,
+                              normalizations=args.norm.split(','),
+                              phrases=args.phrases)
+
     print('master filter list has a total of %i unique terms'
             % len(filter_dict),
             file=stderr
           )
 
+    # counters
+    count = {'t_buckets': 0, 'kw_buckets_in': 0, 'kw_buckets_out': 0 }
+
+    print("filtering input json '%s'" % args.i, file = stderr)
+
+    # optional time aggregation
+    group_of = None
+    if args.merge_k is not None:
+        group_of = merge_k_group(args.merge_k)
+    elif args.merge_by is not None:
+        group_of = calendar_group(args.merge_by)
+
+    # 2bis) streaming mode: filter and output in the same loop
+    if args.stream:
+        print("writing output json to STDOUT (streaming)", file = stderr)
+        stream_filtered_json(args.i, filter_dict, count, stdout, group_of)
+
+        # fyi
+        print ('kept %i/%i "keyword buckets" across %i "time buckets"'
+                % (
+                    count['kw_buckets_out'],
+                    count['kw_buckets_in'],
+                    count['t_buckets']
+                ),
+                file = stderr
+            )
+        exit(0)
+
     # 2) loop the input json
     aggs_f = open(args.i, 'r')
 
@@ -170,43 +684,13 @@ if __name__ == '__main__':
         }
     }
 
-    print("filtering input json '%s'" % args.i, file = stderr)
-
-    # counters
-    count = {'t_buckets': 0, 'kw_buckets_in': 0, 'kw_buckets_out': 0 }
-
-    for time_bucket in aggs_json['aggregations']['weekly']['buckets']:
-        count['t_buckets'] += 1
-
-        # initialize our copy
-        tb_copy = TimeBucket(
-                time_bucket['key_as_string'],
-                time_bucket['key']
-            )
+    filtered_buckets = (filter_time_bucket(time_bucket, filter_dict, count)
+            for time_bucket in aggs_json['aggregations']['weekly']['buckets'])
 
-        # now the keywords
-        for kw in time_bucket['keywords']['buckets']:
-            count['kw_buckets_in'] += 1
-
-            # print(kw)
-            this_term = kw['key']
-
-            # the filtering ------------
-            if this_term in filter_dict:
-                # the keeping
-                this_count = kw['doc_count']
-                tb_copy.kws.append(
-                    {
-                        'key': this_term,
-                        'doc_count': this_count
-                    }
-                )
-                # we add to new total
-                tb_copy.dc += this_count
-
-                # and keep track
-                count['kw_buckets_out'] += 1
+    if group_of is not None:
+        filtered_buckets = merge_time_buckets(filtered_buckets, group_of)
 
+    for tb_copy in filtered_buckets:
         # save the time bucket
         filtered['aggregations']['weekly']['buckets'].append(
             tb_copy.as_dict()
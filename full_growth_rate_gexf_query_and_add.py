@@ -1,6 +1,8 @@
 #! /usr/bin/python3
 """
 Read a gexf and query each node label with an API to create a new node attribute (ex: growth_rate) in the gexf
+
+Several attributes can be computed from the same queries (ex: --attr growth_rate,age)
 """
 __author__    = "Romain Loth"
 __copyright__ = "Copyright 2017 ISCPIF-CNRS"
@@ -10,145 +12,717 @@ __email__     = "romain.loth@iscpif.fr"
 __status__    = "dev"
 
 from argparse  import ArgumentParser
-from sys       import argv, stderr
-from lxml      import etree
+from sys       import argv, stderr, stdout
 from re        import sub, search
 from os        import path
-from requests  import get
-from time      import sleep
+from time      import time
+from json      import dumps, loads
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
+import numpy as np
+from datetime  import datetime, timedelta
+from calendar  import timegm
+from math      import isnan, isfinite
+
+from api_client import ApiClient, PARAM_MAX_RETRIES, PARAM_MAX_DOWNTIME
+from term_counts_store import TermCountsStore
+from gexf_model import GexfGraph
 
 DEFAULT_API_URL = "https://api.iscpif.fr/v2/pub/politic/france/twitter/histogram"
 DEFAULT_API_INTERVAL = "day"
 DEFAULT_ATTRIBUTE = "growth_rate"
 
-PARAM_MAX_RETRIES = 5
+DEFAULT_CONCURRENCY = 8
+DEFAULT_CACHE_PATH = "histograms_cache.sqlite"
+DEFAULT_OVERLAP_DAYS = 7
+
+# query for the total volume (cf. --normalize)
+TOTAL_QUERY = "*"
 
 PARAM_AGE_THRESHOLD = 10
 
-# prepare corresponding namespace
-MY_NS = {"g":"http://www.gexf.net/1.3"}
 
-def get_values(tableName):
-    # read input table
-    vals_per_id = {}
-    table_fh = open(tableName, 'r')
-    for i, line in enumerate(table_fh):
-        line = line.rstrip()
-        try:
-            (nodeid, value) = line.split("\t")
-            # print(nodeid, value)
-            vals_per_id[str(nodeid)] = float(value)
-        except:
-            print('WARN skip tsv line %i ("%s")' % (i, line), file=stderr)
-    table_fh.close()
+##### remote queries #####
+def check_histogram(result_buckets):
+    "raises KeyError/TypeError if the json isn't a histogram response"
+    result_buckets['results']['hits']
+
 
-    # debug print whole dict
-    # print(vals_per_id)
+def check_results(result_buckets):
+    "raises KeyError/TypeError if the json has no results"
+    result_buckets['results']
 
-def add_attr_declaration(xml_tree, attr_name, format = 'float'):
+
+def query_histogram(client, api_url, api_args, expression):
     """
-    for output       NB assumes there already is an <attributes> element
-    (modifies the tree in-place)
+    One histogram query for one expression (with retries, cf. ApiClient)
+
+    returns the json response, or None if we gave up
+    ex: {'results': {'hits': [
+           {'doc_count': 1,
+            'key': 1420070400000,
+            'key_as_string': '2015-01-01T00:00:00.000Z'},
+           {'doc_count': 7488103,
+            'key': 1451606400000,
+            'key_as_string': '2016-01-01T00:00:00.000Z'}
+         ],
+         'took': 506,
+         'total': 20538040}}
     """
-    attrs_declaration = xml_tree.xpath(
-        '/g:gexf/g:graph/g:attributes[@class="node"]',
-        namespaces=MY_NS).pop()
-    new_attr_declaration = etree.Element("attribute")
-    new_attr_declaration.attrib['id']    = attr_name
-    new_attr_declaration.attrib['title'] = attr_name
-    new_attr_declaration.attrib['type']  = format
-    attrs_declaration.append(new_attr_declaration)
+    params = dict(api_args)
+    params['q'] = expression
+
+    return client.get_json(api_url, params, check_histogram,
+                           "'%s'" % expression)
 
 
-def insert_attribute(xml_node, attr_name, attr_val):
+def split_batch_response(result_buckets, expressions):
     """
-    for output
-    (modifies the node in-place)
-    insert into one gexf:node
+    Splits the response of a multi-term query (q[]=a&q[]=b...) per term
+
+    Accepted shapes:
+      - {'results': {'a': {'hits': [...]}, 'b': {'hits': [...]}}}
+      - {'results': [{'q': 'a', 'hits': [...]}, {'q': 'b', 'hits': [...]}]}
+
+    returns {expression: single-term-like response}
+            or None if the api merged all terms in one histogram
+            ie {'results': {'hits': [...]}}
     """
-    current_attrs = xml_node.xpath('g:attvalues', namespaces=MY_NS).pop()
+    results = result_buckets['results']
+    per_term = {}
 
-    # the fragment to add
-    # -------------------
-    # ex: <attvalue for="bidule" value="5.32">
-    new_attr = etree.Element("attvalue")
-    new_attr.attrib['for'] = attr_name
-    new_attr.attrib['value'] = str(attr_val)
+    if isinstance(results, dict):
+        if 'hits' in results:
+            return None
+        for expression in expressions:
+            if (expression in results
+                and isinstance(results[expression], dict)
+                and 'hits' in results[expression]):
+                per_term[expression] = {'results': results[expression]}
 
-    # add in this node
-    current_attrs.append(new_attr)
+    elif isinstance(results, list):
+        for term_results in results:
+            if (isinstance(term_results, dict)
+                and term_results.get('q') in expressions
+                and 'hits' in term_results):
+                per_term[term_results['q']] = {'results': term_results}
 
+    return per_term
 
 
-##### time-aggregation transforms  (buckets => value) #####
-def transform_growth_rate(label_counts, timescale):
+def query_histogram_batch(client, api_url, api_args, expressions, batching):
+    """
+    One multi-term histogram query for several expressions
+
+    If the api doesn't give separate results per term, batching['on'] is
+    set to False (=> next batches directly use single queries).
+    The terms missing in the split response get a single query.
 
-    result = {'format': 'float', 'node_vals':{}}
+    returns a list of (expression, json response or None)
+    """
+    per_term = {}
+
+    if batching['on'] and len(expressions) > 1:
+        params = dict(api_args)
+        params['q[]'] = expressions
+
+        result_buckets = client.get_json(api_url, params, check_results,
+                                   "batch of %i terms" % len(expressions))
+        if result_buckets is not None:
+            per_term = split_batch_response(result_buckets, expressions)
+            if per_term is None:
+                if batching['on']:
+                    print("the api doesn't split multi-term results: "
+                          "switching to one term per query", file=stderr)
+                batching['on'] = False
+                per_term = {}
+
+    return [
+        (expression,
+         per_term[expression] if expression in per_term
+         else query_histogram(client, api_url, api_args, expression))
+        for expression in expressions
+    ]
+
+
+def fetch_all_histograms(expressions, api_url, api_args,
+                         concurrency = DEFAULT_CONCURRENCY, verbose=False,
+                         batch_size = 1, client = None, max_rate = None):
+    """
+    Runs query_histogram for all expressions with a thread pool sharing
+    one ApiClient (a new one or the given one), which adapts the number
+    of simultaneous queries up to concurrency
 
-    infinity = 1000
+    With batch_size > 1, the expressions are grouped in multi-term
+    queries (cf. query_histogram_batch)
 
-    n_ticks = len(timescale)
-    mid = int(n_ticks/2)
-    first_half = timescale[:mid]
-    second_half = timescale[mid:]
+    yields (expression, json response or None) in order of completion
+    """
+    own_client = client is None
+    if own_client:
+        client = ApiClient(concurrency, PARAM_MAX_RETRIES, max_rate,
+                           verbose=verbose)
+    batching = {'on': batch_size > 1}
+    batches = [expressions[i:i+batch_size]
+                for i in range(0, len(expressions), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=client.max_concurrency) as pool:
+        futures = [
+            pool.submit(query_histogram_batch, client, api_url, api_args,
+                        batch, batching)
+            for batch in batches
+        ]
+        for future in as_completed(futures):
+            for expression, result_buckets in future.result():
+                yield (expression, result_buckets)
+    if own_client:
+        if verbose:
+            print("api client stats: %s" % client.stats, file=stderr)
+        client.close()
+
+
+def normalize_label(label):
+    "the query for a node label: lowercase, trimmed and single spaced"
+    return ' '.join(label.lower().split())
+
+
+
+##### persistent cache of the api responses #####
+class HistogramCache:
+    """
+    SQLite cache of the api json responses
+    keyed by url, q, since, until, interval
 
-    # print("first_half", first_half, file=stderr)
-    # print("second_half", second_half, file=stderr)
+    Each response is committed as soon as it's stored, so a run that died
+    can be restarted and only the missing labels will be queried again.
+    (NB: use it from one thread only)
+    """
+    def __init__(self, db_path, ttl = None):
+        "ttl: max age of the cached responses in seconds (None = no expiry)"
+        self.ttl = ttl
+        self.db = sqlite3.connect(db_path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url        TEXT NOT NULL,
+                q          TEXT NOT NULL,
+                since      TEXT NOT NULL,
+                until      TEXT NOT NULL,
+                interval   TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                response   TEXT NOT NULL,
+                PRIMARY KEY (url, q, since, until, interval)
+            )""")
+        self.db.commit()
+
+    @staticmethod
+    def key(api_url, api_args, expression):
+        "the primary key (absent since/until are stored as '')"
+        return (api_url, expression,
+                api_args.get('since', '') or '',
+                api_args.get('until', '') or '',
+                api_args.get('interval', '') or '')
+
+    def get(self, api_url, api_args, expression):
+        "the cached json response or None (if absent or expired)"
+        row = self.db.execute("""
+            SELECT fetched_at, response FROM responses
+            WHERE url=? AND q=? AND since=? AND until=? AND interval=?""",
+            self.key(api_url, api_args, expression)).fetchone()
+        if row is None:
+            return None
+        elif self.ttl is not None and time() - row[0] > self.ttl:
+            return None
+        else:
+            return loads(row[1])
 
-    for label in label_counts:
-        first_sum = 0
-        second_sum = 0
+    def put(self, api_url, api_args, expression, result_buckets):
+        self.db.execute("""
+            INSERT OR REPLACE INTO responses
+            (url, q, since, until, interval, fetched_at, response)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            self.key(api_url, api_args, expression)
+              + (time(), dumps(result_buckets)))
+        self.db.commit()
 
-        for timebucket in first_half:
-            if timebucket in all_counts[label]:
-                val = all_counts[label][timebucket]
-                first_sum += val
+    def close(self):
+        self.db.close()
 
-        for timebucket in second_half:
-            if timebucket in all_counts[label]:
-                val = all_counts[label][timebucket]
-                second_sum += val
 
 
-        if first_sum > 0:
-            result['node_vals'][label] = "%.3f" % (second_sum / first_sum)
-        elif second_sum > 0:
-            result['node_vals'][label] = infinity
+##### stored series for incremental refresh #####
+class SeriesStore:
+    """
+    SQLite store of the merged bucket series of each label, with the
+    since/until window they cover, so that a later run with a moved
+    until only needs to query the missing tail
+    (NB: use it from one thread only)
+    """
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS series (
+                url        TEXT NOT NULL,
+                q          TEXT NOT NULL,
+                interval   TEXT NOT NULL,
+                bucket_key TEXT NOT NULL,
+                epoch_key  INTEGER NOT NULL,
+                doc_count  INTEGER NOT NULL,
+                PRIMARY KEY (url, q, interval, bucket_key)
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS series_windows (
+                url        TEXT NOT NULL,
+                q          TEXT NOT NULL,
+                interval   TEXT NOT NULL,
+                since      TEXT NOT NULL,
+                until      TEXT NOT NULL,
+                PRIMARY KEY (url, q, interval)
+            )""")
+        self.db.commit()
+
+    def window(self, api_url, expression, interval):
+        "(since, until) already covered for this label or None"
+        return self.db.execute("""
+            SELECT since, until FROM series_windows
+            WHERE url=? AND q=? AND interval=?""",
+            (api_url, expression, interval)).fetchone()
+
+    def merge(self, api_url, expression, interval, hits, since, until):
+        """
+        stores new hits (replacing the overlapped buckets)
+        and extends the covered window to until
+        """
+        self.db.executemany("""
+            INSERT OR REPLACE INTO series
+            (url, q, interval, bucket_key, epoch_key, doc_count)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            [(api_url, expression, interval,
+              hit['key_as_string'], hit['key'], hit['doc_count'])
+                for hit in hits])
+        previous = self.window(api_url, expression, interval)
+        if previous is not None:
+            since = min(since, previous[0])
+        self.db.execute("""
+            INSERT OR REPLACE INTO series_windows
+            (url, q, interval, since, until) VALUES (?, ?, ?, ?, ?)""",
+            (api_url, expression, interval, since, until))
+        self.db.commit()
+
+    def hits(self, api_url, expression, interval, since, until):
+        """
+        the stored buckets between since and until (as api hits),
+        with the bucket that contains since
+        """
+        rows = self.db.execute("""
+            SELECT bucket_key, epoch_key, doc_count FROM series
+            WHERE url=? AND q=? AND interval=?
+              AND epoch_key >= ? AND epoch_key <= ?
+            ORDER BY epoch_key""",
+            (api_url, expression, interval,
+             date_to_epoch_key(bucket_start(since, interval)),
+             date_to_epoch_key(until))).fetchall()
+        return [{'key_as_string': row[0], 'key': row[1], 'doc_count': row[2]}
+                    for row in rows]
+
+    def close(self):
+        self.db.close()
+
+
+def date_to_epoch_key(date_string):
+    "'2017-01-01' => epoch in ms like the ES 'key' of the buckets"
+    date = datetime.strptime(date_string[:10], '%Y-%m-%d')
+    return timegm(date.timetuple()) * 1000
+
+
+# the api intervals for which we know the bucket starts (cf. --incremental)
+BUCKET_INTERVALS = ('day', 'week', 'month', 'quarter', 'year')
+
+
+def bucket_start(date_string, interval):
+    """
+    the start of the api bucket that contains a date
+    ex: ('2017-03-24', 'month') => '2017-03-01'
+        ('2017-03-24', 'week')  => '2017-03-20' (ES weeks start on monday)
+    """
+    date = datetime.strptime(date_string[:10], '%Y-%m-%d')
+    if interval == 'week':
+        date -= timedelta(days=date.weekday())
+    elif interval == 'month':
+        date = date.replace(day=1)
+    elif interval == 'quarter':
+        date = date.replace(month=date.month - (date.month - 1) % 3, day=1)
+    elif interval == 'year':
+        date = date.replace(month=1, day=1)
+    return date.strftime('%Y-%m-%d')
+
+
+def incremental_histograms(store, expressions, api_url, api_args,
+                           overlap_days, client, batch_size = 1,
+                           offline = False):
+    """
+    Refreshes the stored series of each expression up to api_args['until']
+
+     - a label with a stored window covering since is only queried from
+       (stored until - overlap_days), to get the new buckets and the late
+       counts of the last ones (rounded down to the start of its bucket:
+       a partial bucket would replace the full stored count)
+     - a label without stored window (or with a later since) is queried
+       on the whole since/until window
+     - a label already covering until isn't queried
+
+    yields (expression, hits between since and until) for all expressions
+    """
+    since = api_args['since']
+    until = api_args['until']
+    interval = api_args['interval']
+
+    # the query start for each label (None => nothing to query)
+    query_since = {}
+    for expression in expressions:
+        window = store.window(api_url, expression, interval)
+        if window is None or window[0] > since:
+            query_since[expression] = since
+        elif window[1] >= until:
+            query_since[expression] = None
         else:
-            result['node_vals'][label] = -1
+            tail_start = (datetime.strptime(window[1][:10], '%Y-%m-%d')
+                            - timedelta(days=overlap_days))
+            query_since[expression] = bucket_start(
+                    max(since, tail_start.strftime('%Y-%m-%d')), interval)
+
+    # labels grouped by query start (typically: all the same)
+    to_fetch = {}
+    for expression, tail_since in query_since.items():
+        if tail_since is not None:
+            to_fetch.setdefault(tail_since, []).append(expression)
+
+    print("incremental: %i labels up to date, %i to query%s"
+            % (len(expressions) - sum(len(e) for e in to_fetch.values()),
+               sum(len(e) for e in to_fetch.values()),
+               " (skipped: offline)" if offline else ""),
+            file=stderr)
+
+    if not offline:
+        for tail_since in sorted(to_fetch):
+            tail_args = dict(api_args)
+            tail_args['since'] = tail_since
+            for expression, result_buckets in fetch_all_histograms(
+                    to_fetch[tail_since], api_url, tail_args,
+                    batch_size=batch_size, client=client):
+                if result_buckets is None:
+                    print("keeping the stored series for '%s'" % expression,
+                          file=stderr)
+                else:
+                    store.merge(api_url, expression, interval,
+                                result_buckets['results']['hits'],
+                                tail_since, until)
+
+    for expression in expressions:
+        yield (expression,
+               store.hits(api_url, expression, interval, since, until))
 
-    return result
 
 
-def transform_age(label_counts, timescale):
+##### dense counts matrix #####
+class CountsMatrix:
     """
-    for each label, returns first date where label_count > 0
+    The fetched histograms as a dense matrix: one row per label
+    and one column per time bucket of the sorted timescale
+
+     .labels      list of labels (row order)
+     .label_index {label: row}
+     .scale       sorted bucket keys (ex: '2017-01-01T00:00:00.000Z')
+     .epoch_keys  array of the corresponding epoch keys
+     .counts      array (n_labels x n_buckets) of doc_counts
+                  (0 where the api returned no bucket)
+                  or of float ratios after normalize()
     """
+    def __init__(self, all_counts, timebuckets_census):
+        self.labels = list(all_counts)
+        self.label_index = {label: i for i, label in enumerate(self.labels)}
+        self.scale = sorted(timebuckets_census)
+        self.epoch_keys = np.array(
+            [timebuckets_census[k] for k in self.scale], dtype=np.int64)
+
+        col_index = {k: j for j, k in enumerate(self.scale)}
+        self.counts = np.zeros((len(self.labels), len(self.scale)),
+                               dtype=np.int32)
+        for i, label in enumerate(self.labels):
+            label_counts = all_counts[label]
+            if len(label_counts):
+                cols = [col_index[k] for k in label_counts]
+                self.counts[i, cols] = list(label_counts.values())
+
+    def normalize(self, total_counts):
+        """
+        divides each column by the total count of its bucket
+        (total_counts: {bucket_key: val for q='*'}, missing or 0 => 0)
+        (modifies the matrix in-place: counts become float32 ratios)
+        """
+        totals = np.array([total_counts.get(k, 0) for k in self.scale],
+                          dtype=np.float64)
+        normalized = np.zeros(self.counts.shape, dtype=np.float32)
+        np.divide(self.counts, totals, out=normalized,
+                  where=totals > 0, casting='unsafe')
+        self.counts = normalized
+
+    def as_node_vals(self, values, formatter = str):
+        "one value per row => {label: formatted value}"
+        return {label: formatter(val)
+                    for label, val in zip(self.labels, values.tolist())}
+
+
+
+##### time-aggregation transforms  (counts matrix => value) #####
+# attr_name => {'fun': batch transform, 'format': gexf attribute type,
+#               'formatter': value => str, 'params': default params}
+AVAILABLE_FUNCTIONS = {}
+
+def register_transform(name, format, formatter = str, **default_params):
+    """
+    decorator to add a batch transform in AVAILABLE_FUNCTIONS
+
+    The transform gets the whole CountsMatrix (+ its params as kwargs) and
+    returns an array with one value per row (NaN => no value for the node)
+    """
+    def register(fun):
+        AVAILABLE_FUNCTIONS[name] = {
+            'fun': fun,
+            'format': format,
+            'formatter': formatter,
+            'params': default_params
+        }
+        return fun
+    return register
+
+
+def apply_transform(name, counts_matrix, params = {}):
+    """
+    runs a registered transform with its default params updated by params
+
+    returns {'format': gexf type, 'node_vals': {label: formatted value}}
+    """
+    transform = AVAILABLE_FUNCTIONS[name]
+    all_params = dict(transform['params'])
+    all_params.update(params)
+    values = transform['fun'](counts_matrix, **all_params)
+    return {
+        'format': transform['format'],
+        'node_vals': counts_matrix.as_node_vals(values, transform['formatter'])
+    }
+
+
+def map_row_chunks(fun, counts, chunk_rows = 10000):
+    "fun on blocks of rows (bounds the size of float temporary arrays)"
+    if counts.shape[0] <= chunk_rows:
+        return fun(counts)
+    return np.concatenate([fun(counts[i:i+chunk_rows])
+                            for i in range(0, counts.shape[0], chunk_rows)])
+
+
+def ratio_with_infinity(numerators, denominators, infinity = 1000):
+    "x/y, or infinity if y == 0 < x, or -1 if both are 0"
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = numerators / denominators
+    return np.where(denominators > 0, ratios,
+                    np.where(numerators > 0, infinity, -1))
 
-    # value will be epoch key
-    result = {'format': 'int', 'node_vals':{}}
 
-    for label in label_counts:
-        apparition_time = 0
+def format_rate(val, infinity = 1000):
+    "finite rates keep 3 decimals, infinity and -1 stay ints"
+    if val == infinity or val == -1:
+        return int(val)
+    return "%.3f" % val
 
-        for timebucket in timescale:
-            if timebucket in all_counts[label]:
-                if all_counts[label][timebucket] > PARAM_AGE_THRESHOLD:
-                    # we use timebuckets_census to retrieve also epoch keys
-                    apparition_time = timebuckets_census[timebucket]
-                    break
 
-        result['node_vals'][label] = apparition_time
+def format_float(val):
+    "(6 significant digits: the normalized values can be small)"
+    return None if isnan(val) else "%.6g" % val
+
+
+def format_int(val):
+    return None if isnan(val) else int(val)
+
+
+@register_transform('growth_rate', 'float', format_rate)
+def transform_growth_rate(counts_matrix):
+    """
+    for each label, ratio of the sums of counts over
+    the 2nd half / the 1st half of the timescale
+    (or infinity if the 1st half is empty, -1 if both are empty)
+    """
+    counts = counts_matrix.counts
+    mid = int(counts.shape[1]/2)
+    first_sums = counts[:, :mid].sum(axis=1)
+    second_sums = counts[:, mid:].sum(axis=1)
+    return ratio_with_infinity(second_sums, first_sums)
+
+
+@register_transform('age', 'long', format_int, threshold = PARAM_AGE_THRESHOLD)
+def transform_age(counts_matrix, threshold):
+    """
+    for each label, returns first date where label_count > threshold
+    (as epoch key, or 0 if never)
+    """
+    above = counts_matrix.counts > threshold
+    if not len(counts_matrix.epoch_keys):
+        return np.zeros(len(counts_matrix.labels), dtype=np.int64)
+
+    # argmax gives the first True column
+    first_cols = above.argmax(axis=1)
+    return np.where(above.any(axis=1), counts_matrix.epoch_keys[first_cols], 0)
+
+
+@register_transform('peak_date', 'long', format_int)
+def transform_peak_date(counts_matrix):
+    """
+    for each label, date of the max count (as epoch key)
+    (1st one if several, no value if all counts are 0)
+    """
+    counts = counts_matrix.counts
+    if not counts.shape[1]:
+        return np.full(counts.shape[0], np.nan)
+    peak_cols = counts.argmax(axis=1)
+    return np.where(counts.max(axis=1) > 0,
+                    counts_matrix.epoch_keys[peak_cols], np.nan)
+
+
+@register_transform('trend_slope', 'float', format_float)
+def transform_trend_slope(counts_matrix):
+    """
+    for each label, least squares slope of the counts by time bucket
+    """
+    n_ticks = counts_matrix.counts.shape[1]
+    if n_ticks < 2:
+        return np.full(counts_matrix.counts.shape[0], np.nan)
+
+    # slope = sum((x - mean_x) * y) / sum((x - mean_x)^2)
+    x_centered = np.arange(n_ticks) - (n_ticks - 1) / 2
+    denominator = (x_centered ** 2).sum()
+    return map_row_chunks(lambda block: block @ x_centered / denominator,
+                          counts_matrix.counts)
+
+
+@register_transform('burstiness', 'float', format_float)
+def transform_burstiness(counts_matrix):
+    """
+    for each label, (sigma - mu) / (sigma + mu) of the counts
+    (-1: perfectly regular, 0: poisson-like, towards 1: bursty)
+    """
+    def burstiness(block):
+        means = block.mean(axis=1, dtype=np.float64)
+        stds = block.std(axis=1, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (stds - means) / (stds + means)
+    return map_row_chunks(burstiness, counts_matrix.counts)
+
+
+@register_transform('cv', 'float', format_float)
+def transform_cv(counts_matrix):
+    """
+    for each label, coefficient of variation (sigma / mu) of the counts
+    """
+    def cv(block):
+        means = block.mean(axis=1, dtype=np.float64)
+        stds = block.std(axis=1, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(means > 0, stds / means, np.nan)
+    return map_row_chunks(cv, counts_matrix.counts)
+
+
+@register_transform('momentum', 'float', format_float,
+                     short_window = 7, long_window = 28)
+def transform_momentum(counts_matrix, short_window, long_window):
+    """
+    for each label, moving average of the counts over the last short_window
+    buckets minus moving average over the last long_window buckets
+    (> 0: accelerating)
+    """
+    counts = counts_matrix.counts
+    short_window = max(1, min(int(short_window), counts.shape[1]))
+    long_window = max(1, min(int(long_window), counts.shape[1]))
+    if not counts.shape[1]:
+        return np.full(counts.shape[0], np.nan)
+    short_means = counts[:, -short_window:].mean(axis=1, dtype=np.float64)
+    long_means = counts[:, -long_window:].mean(axis=1, dtype=np.float64)
+    return short_means - long_means
+
+
+@register_transform('recent_ratio', 'float', format_rate, window = 7)
+def transform_recent_ratio(counts_matrix, window):
+    """
+    for each label, sum of the counts over the last window buckets
+    / sum over the previous window buckets
+    (or infinity if the previous ones are empty, -1 if both are empty)
+    """
+    counts = counts_matrix.counts
+    window = max(1, int(window))
+    last_sums = counts[:, -window:].sum(axis=1)
+    previous_sums = counts[:, -2*window:-window].sum(axis=1)
+    return ratio_with_infinity(last_sums, previous_sums)
 
-    return result
 
+def parse_transform_params(param_strings, attr_name):
+    """
+    ['threshold=20', 'age.threshold=15', 'momentum.long_window=56'...]
+     => params for the transform attr_name
 
+    (a 'name.param' value has priority over a plain 'param' value)
+    """
+    known = AVAILABLE_FUNCTIONS[attr_name]['params']
+    general = {}
+    specific = {}
+    for param_string in param_strings:
+        (param_name, value) = param_string.split('=', 1)
+        value = float(value)
+        if value.is_integer():
+            value = int(value)
+        if '.' in param_name:
+            (transform_name, param_name) = param_name.split('.', 1)
+            if transform_name != attr_name:
+                continue
+            if param_name not in known:
+                raise KeyError("'%s' has no param '%s'"
+                                % (attr_name, param_name))
+            specific[param_name] = value
+        elif param_name in known:
+            general[param_name] = value
+    general.update(specific)
+    return general
+
+
+def check_params(param_strings, attr_names):
+    """
+    raises KeyError for a param unknown to the transforms:
+      - plain 'param=value': unknown to all the attr_names
+      - 'name.param=value': unknown transform name or param
+    and ValueError for a value that isn't a finite number
+    """
+    for param_string in param_strings:
+        if '=' not in param_string:
+            raise ValueError("'%s' isn't like name=value" % param_string)
+        (param_name, value) = param_string.split('=', 1)
+        if not isfinite(float(value)):
+            raise ValueError("'%s' isn't a finite number" % param_string)
+        if '.' in param_name:
+            (transform_name, param_name) = param_name.split('.', 1)
+            if transform_name not in AVAILABLE_FUNCTIONS:
+                raise KeyError("unknown transform '%s' (possible choices: %s)"
+                                % (transform_name,
+                                   ", ".join(AVAILABLE_FUNCTIONS)))
+            if param_name not in AVAILABLE_FUNCTIONS[transform_name]['params']:
+                raise KeyError("'%s' has no param '%s'"
+                                % (transform_name, param_name))
+        elif not any(param_name in AVAILABLE_FUNCTIONS[attr_name]['params']
+                     for attr_name in attr_names):
+            raise KeyError("no param '%s' in %s"
+                            % (param_name, ", ".join(attr_names)))
 
-# attr_name => bucket ags
-AVAILABLE_FUNCTIONS = {
-    "growth_rate": transform_growth_rate,
-    "age": transform_age,
-}
 
 
 if __name__ == '__main__':
@@ -185,11 +759,18 @@ if __name__ == '__main__':
     # NB this triggers an associated function from AVAILABLE_FUNCTIONS
     parser.add_argument('--attr',
         metavar='new_attribute_tagname',
-        help='name for the new attribute (possible choices: growth_rate, age)',
+        help='name for the new attribute, or comma-separated names to compute several attributes from the same queries (possible choices: %s)' % ", ".join(AVAILABLE_FUNCTIONS),
         default=DEFAULT_ATTRIBUTE,
         required=False,
         action='store')
 
+    parser.add_argument('--param',
+        metavar='threshold=10',
+        help='param of the transform for --attr, as name=value or attr.name=value (repeatable) ex: --param age.threshold=20 --param window=14',
+        default=[],
+        required=False,
+        action='append')
+
     parser.add_argument('--apiSince',
         metavar='2017-01-01',
         help='since param for the api',
@@ -209,34 +790,159 @@ if __name__ == '__main__':
         required=False,
         action='store')
 
+    parser.add_argument('--concurrency',
+        metavar='8',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help='max number of simultaneous queries to the api, the actual number adapts to the api response times and errors (default: %i)' % DEFAULT_CONCURRENCY,
+        required=False,
+        action='store')
+
+    parser.add_argument('--maxRate',
+        metavar='req/s',
+        type=float,
+        default=None,
+        help='max number of queries per second (default: no limit)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--maxRetries',
+        metavar='%i' % PARAM_MAX_RETRIES,
+        type=int,
+        default=PARAM_MAX_RETRIES,
+        help='retries of a failed query before giving up on it (default: %i)' % PARAM_MAX_RETRIES,
+        required=False,
+        action='store')
+
+    parser.add_argument('--maxDowntime',
+        metavar='%i' % PARAM_MAX_DOWNTIME,
+        type=float,
+        default=PARAM_MAX_DOWNTIME,
+        help='seconds the api can look down (open circuit breaker) before all the pending queries give up (default: %i)' % PARAM_MAX_DOWNTIME,
+        required=False,
+        action='store')
+
+    parser.add_argument('--batchSize',
+        metavar='1',
+        type=int,
+        default=1,
+        help='number of labels per query (as q[]=a&q[]=b...) if the api gives separate results per term (default: 1, ie one label per query)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--exactLabels',
+        default=False,
+        help='query each distinct label as is (by default the labels are lowercased and their spaces normalized, so that case/spacing variants share one query)',
+        required=False,
+        action='store_true')
+
+    parser.add_argument('--cache',
+        metavar='pathto/cache.sqlite',
+        default=DEFAULT_CACHE_PATH,
+        help='sqlite file where the api responses are kept, to resume a run or to recompute attributes without querying again (default: %s)' % DEFAULT_CACHE_PATH,
+        required=False,
+        action='store')
+
+    parser.add_argument('--cacheTTL',
+        metavar='hours',
+        type=float,
+        default=None,
+        help='max age of the cached responses (default: no expiry)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--noCache',
+        default=False,
+        help='don\'t read nor write the cache',
+        required=False,
+        action='store_true')
+
+    parser.add_argument('--offline',
+        default=False,
+        help='no api queries at all: the values are computed from the cached responses only',
+        required=False,
+        action='store_true')
+
+    parser.add_argument('--incremental',
+        default=False,
+        help='keep the bucket series of each label in the cache file and only query the days after the last run (+ --overlapDays, from the start of their bucket), ex: for a weekly refresh with a moved --apiUntil (needs --apiSince and --apiUntil, and an --apiInterval among day, week, month, quarter, year)',
+        required=False,
+        action='store_true')
+
+    parser.add_argument('--overlapDays',
+        metavar='7',
+        type=int,
+        default=DEFAULT_OVERLAP_DAYS,
+        help='with --incremental, number of already stored days queried again to get their late counts (default: %i)' % DEFAULT_OVERLAP_DAYS,
+        required=False,
+        action='store')
+
+    parser.add_argument('--countsStore',
+        metavar='pathto/storedir',
+        help='local store of crawled histograms (cf. term_counts_store.py, same granularity as --apiInterval): the labels found there are not queried',
+        required=False,
+        action='store')
+
     parser.add_argument('--verbose',
         default=False,
         help='more runtime logs',
         required=False,
         action='store_true')
 
-    # parser.add_argument('--normalize',
-    #     default=False,
-    #     type = bool,
-    #     help='divide by the total counts',
-    #     required=False,
-    #     action='store')
+    parser.add_argument('--normalize',
+        default=False,
+        help='divide the counts of each time bucket by the total counts of the bucket (one more query for q="*") before computing the attributes (NB: then age needs an explicit threshold ratio, ex: --param age.threshold=0.0001)',
+        required=False,
+        action='store_true')
 
     args = parser.parse_args(argv[1:])
 
-    if args.attr:
-        # normalize name of the new attribute
-        new_attr_name = sub(r'\W+', '_', args.attr)
+    if args.batchSize < 1:
+        parser.error("--batchSize must be >= 1")
+    if args.offline and args.noCache:
+        parser.error("--offline needs the cache")
+    if args.incremental:
+        if args.noCache:
+            parser.error("--incremental needs the cache")
+        if not (args.apiSince and args.apiUntil):
+            parser.error("--incremental needs --apiSince and --apiUntil")
+        if args.apiInterval not in BUCKET_INTERVALS:
+            parser.error("--incremental needs an --apiInterval among %s"
+                         % ", ".join(BUCKET_INTERVALS))
+
+    # normalize names of the new attributes
+    new_attr_names = []
+    for attr in args.attr.split(','):
+        new_attr_name = sub(r'\W+', '_', attr)
         new_attr_name = sub(r'^_+', '', new_attr_name)
         new_attr_name = sub(r'_+$', '', new_attr_name)
-
-    # read input xml graph
-    xml_tree = etree.parse(args.gexf)
-
-    print("==READ xml tree: finished==", file=stderr)
-
-    # get all nodes by xpath
-    nodes = xml_tree.xpath('/g:gexf/g:graph/g:nodes/g:node', namespaces=MY_NS)
+        if new_attr_name not in AVAILABLE_FUNCTIONS:
+            parser.error("unknown --attr '%s' (possible choices: %s)"
+                            % (new_attr_name, ", ".join(AVAILABLE_FUNCTIONS)))
+        if new_attr_name not in new_attr_names:
+            new_attr_names.append(new_attr_name)
+
+    # the params of each transform
+    transform_params = {}
+    try:
+        check_params(args.param, new_attr_names)
+        for new_attr_name in new_attr_names:
+            transform_params[new_attr_name] = parse_transform_params(
+                                                args.param, new_attr_name)
+    except (ValueError, KeyError) as e:
+        parser.error("bad --param: %s" % e)
+
+    # normalized counts are ratios <= 1: the default age threshold (a
+    # count) would give age=0 on every node
+    if (args.normalize and 'age' in new_attr_names
+        and 'threshold' not in transform_params['age']):
+        parser.error("with --normalize, age needs a threshold ratio "
+                     "(ex: --param age.threshold=0.0001)")
+
+    # read the nodes of the input graph (ids and labels only)
+    graph = GexfGraph(args.gexf, attr_names=[])
+
+    print("==READ gexf nodes: finished==", file=stderr)
 
     api_args = {"interval":args.apiInterval }
 
@@ -248,101 +954,176 @@ if __name__ == '__main__':
     print('api_args', api_args, file=stderr)
 
     # READ
-    for node in nodes:
-        expression = node.attrib['label']
-
-        if len(expression):
-
-            result_buckets = None
+    # unique queries for all the nodes
+    # ex: "Climate  change" and "climate change" => one query
+    query_of = {}
+    for label in graph.labels:
+        if label is None:
+            continue
+        if args.exactLabels:
+            query_of[label] = label
+        else:
+            query_of[label] = normalize_label(label)
+
+    expressions = sorted(set(q for q in query_of.values() if len(q)))
+
+    # the total volume query comes with the others (cache, retries...)
+    if args.normalize and TOTAL_QUERY not in expressions:
+        expressions.append(TOTAL_QUERY)
+
+    print("%i nodes => %i unique queries"
+            % (len(graph), len(expressions)),
+            file=stderr)
+
+    # 0 - what we have in the local counts store
+    stored_hits = []
+    api_expressions = expressions
+    if args.countsStore:
+        counts_store = TermCountsStore(args.countsStore)
+        if counts_store.granularity != args.apiInterval:
+            print("ERR: the counts store has %s periods, not %s (--apiInterval)"
+                  % (counts_store.granularity, args.apiInterval), file=stderr)
+            exit(1)
+
+        api_expressions = []
+        for expression in expressions:
+            hits = counts_store.hits(expression, args.apiSince, args.apiUntil,
+                                     by_label=True)
+            if hits is None:
+                api_expressions.append(expression)
+            else:
+                stored_hits.append((expression, hits))
+
+        print("%i labels from the counts store" % len(stored_hits),
+              file=stderr)
+
+    # 1 - what we already have in the cache
+    cache = None
+    cached_results = []
+    to_fetch = api_expressions
+    if args.incremental:
+        # (the stored series replace the responses cache)
+        pass
+    elif not args.noCache:
+        ttl = None
+        if args.cacheTTL is not None:
+            ttl = args.cacheTTL * 3600
+        cache = HistogramCache(args.cache, ttl)
+
+        to_fetch = []
+        for expression in api_expressions:
+            result_buckets = cache.get(args.url, api_args, expression)
+            if result_buckets is None:
+                to_fetch.append(expression)
+            else:
+                cached_results.append((expression, result_buckets))
+
+    if not args.incremental:
+        print("%i labels from cache, %i to query%s"
+                % (len(cached_results), len(to_fetch),
+                   " (skipped: offline)" if args.offline else ""),
+                file=stderr)
+
+    # 2 - the remote queries
+    # (shared client: adapts the concurrency and rate to the api)
+    client = ApiClient(args.concurrency, args.maxRetries, args.maxRate,
+                       verbose=args.verbose, max_downtime=args.maxDowntime)
+
+    def all_hits():
+        "yields (expression, hits) from the counts store, the cache/store and the api"
+        for expression, hits in stored_hits:
+            yield (expression, hits)
+
+        if args.incremental:
+            store = SeriesStore(args.cache)
+            for expression, hits in incremental_histograms(
+                                        store, api_expressions, args.url,
+                                        api_args, args.overlapDays,
+                                        client, args.batchSize,
+                                        args.offline):
+                yield (expression, hits)
+            store.close()
+            return
+
+        fetched_results = []
+        if not args.offline:
+            fetched_results = fetch_all_histograms(
+                                            to_fetch, args.url, api_args,
+                                            batch_size=args.batchSize,
+                                            client=client)
+
+        for i, (expression, result_buckets) in enumerate(
+                                    chain(cached_results, fetched_results)):
+            if result_buckets is None:
+                result_buckets = {'results': {'hits': []}}
+            elif cache is not None and i >= len(cached_results):
+                # new response: saved right away for a later resume
+                cache.put(args.url, api_args, expression, result_buckets)
+            yield (expression, result_buckets['results']['hits'])
+
+    for expression, hits in all_hits():
+        if args.verbose:
+            print('===== expression:"%s" =====' % expression, file=stderr)
+
+        for hit in hits:
 
             if args.verbose:
-                print('===== expression:"%s" =====' % expression, file=stderr)
-
-            # REMOTE QUERY
-            api_args['q'] = expression
-            resp = get(args.url, params=api_args)
+                print("hit", hit, file=stderr)
+            bucket_key = hit['key_as_string']
 
-            if args.verbose:
-                print('queryied url:', resp.url, file=stderr)
-
-            try:
-                result_buckets = resp.json()
-                # ex:
-                # {'results': {'hits': [
-                #    {'doc_count': 1,
-                #     'key': 1420070400000,
-                #     'key_as_string': '2015-01-01T00:00:00.000Z'},
-                #    {'doc_count': 7488103,
-                #     'key': 1451606400000,
-                #     'key_as_string': '2016-01-01T00:00:00.000Z'},
-                #    {'doc_count': 13049936,
-                #     'key': 1483228800000,
-                #     'key_as_string': '2017-01-01T00:00:00.000Z'}
-                #  ],
-                # 'took': 506,
-                # 'total': 20538040}}
-            except:
-                nretries = 0
-                while result_buckets is None and nretries < PARAM_MAX_RETRIES:
-                    # wait two seconds and retry
-                    sleep(2)
-                    nretries += 1
-                    print("retrying %i query for '%s'" % (nretries, expression), file=stderr)
-                    try:
-                        resp = get(args.url, params=api_args)
-                        result_buckets = resp.json()
-                    except:
-                        pass
-                if result_buckets is None:
-                    print("GIVING UP query for '%s'" % expression, file=stderr)
-                    result_buckets = {'hits': []}
+            # global census
+            timebuckets_census[bucket_key] = hit['key']
 
+            # per-word counts
+            if expression not in all_counts:
+                all_counts[expression] = {}
+            all_counts[expression][bucket_key] = hit["doc_count"]
 
+    client.close()
+    print("api client stats: %s" % client.stats, file=stderr)
 
-            for hit in result_buckets['results']['hits']:
-
-                if args.verbose:
-                    print("hit", hit, file=stderr)
-                bucket_key = hit['key_as_string']
-
-                # global census
-                timebuckets_census[bucket_key] = hit['key']
-
-                # per-word counts
-                if expression not in all_counts:
-                    all_counts[expression] = {}
-                all_counts[expression][bucket_key] = hit["doc_count"]
+    if cache is not None:
+        cache.close()
 
     # print(all_counts, file=stderr)
 
-    timebuckets_scale = sorted([k for k in timebuckets_census])
-
-    # print("sorted entries in timebucket", "\n".join(timebuckets_scale), file=stderr)
-
+    if args.normalize:
+        if TOTAL_QUERY in query_of.values():
+            total_counts = all_counts.get(TOTAL_QUERY, {})
+        else:
+            total_counts = all_counts.pop(TOTAL_QUERY, {})
+        if not len(total_counts):
+            print("no total counts for q='%s': can't normalize" % TOTAL_QUERY,
+                  file=stderr)
+            exit(1)
 
+    # pack all the histograms in a dense matrix
+    counts_matrix = CountsMatrix(all_counts, timebuckets_census)
 
-    # apply a transformation (all_counts, scale) => one value per label
+    if args.normalize:
+        counts_matrix.normalize(total_counts)
+    timebuckets_scale = counts_matrix.scale
 
-    my_bucket_aggregation = AVAILABLE_FUNCTIONS[new_attr_name]
+    # print("sorted entries in timebucket", "\n".join(timebuckets_scale), file=stderr)
 
-    # results = transform_growth_rate(all_counts, timebuckets_scale)
-    results = my_bucket_aggregation(all_counts, timebuckets_scale)
+    # apply the transformations (counts matrix) => one value per label
+    all_results = {}
+    for new_attr_name in new_attr_names:
+        all_results[new_attr_name] = apply_transform(
+                new_attr_name, counts_matrix, transform_params[new_attr_name])
 
 
     # WRITE OUTPUT
-    # 1 - add once the attribute declaration
-    add_attr_declaration(xml_tree, new_attr_name, results['format'])
-
-    # 2 - insert computed value in each nodes' xml
-    for node in nodes:
-        this_node_label = node.attrib['label']
-
-        if this_node_label in results['node_vals'] and results['node_vals'][this_node_label] is not None:
-            node = insert_attribute(
-                    node, new_attr_name,
-                    results['node_vals'][this_node_label])
-        # else:
-        #     print("no value for node %s" % this_node_label, file=stderr)
-
-    # print resulting XML to STDOUT
-    print(etree.tostring(xml_tree, pretty_print=True).decode('UTF-8'))
+    # the computed values of each node (by its query)
+    for new_attr_name in new_attr_names:
+        results = all_results[new_attr_name]
+        graph.set(new_attr_name,
+                  [results['node_vals'].get(query_of.get(label))
+                   for label in graph.labels],
+                  results['format'], kind='string')
+
+    # stream the gexf to STDOUT with the attributes added (or updated)
+    stat_values = graph.write(stdout.buffer)
+
+    print('Values added: %(added)i, updated: %(updated)i, unchanged: %(unchanged)i'
+          % stat_values, file=stderr)
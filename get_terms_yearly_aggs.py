@@ -0,0 +1,252 @@
+#! /usr/bin/python3
+"""
+Crawl the yearly histogram of each term of a list (like the loops of
+get_terms_yearly_aggs_loop.bash) with concurrent queries
+
+ - term list: one term per line, or "id<tab>term" lines (preexisting ids)
+ - output: outdir/0042-some_term_.json (same names as the bash loop)
+ - each response is validated, then written atomically (tmp + rename)
+ - on restart, the terms whose file is already valid are skipped
+"""
+__author__    = "Romain Loth"
+__copyright__ = "Copyright 2016 ISCPIF-CNRS"
+__license__   = "LGPL"
+__version__   = "1"
+__email__     = "romain.loth@iscpif.fr"
+__status__    = "dev"
+
+from argparse  import ArgumentParser
+from sys       import argv, stderr
+from json      import load, dump
+from re        import sub
+from os        import path, makedirs, replace
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from api_client import ApiClient, PARAM_MAX_RETRIES, PARAM_MAX_DOWNTIME
+
+DEFAULT_API_URL = "https://api.iscpif.fr/1/wos/search/histogram.json"
+DEFAULT_OUTDIR = "newcrawled"
+DEFAULT_CONCURRENCY = 4
+DEFAULT_USER_AGENT = "rloth script"
+
+FROM_YEAR = 2000
+UPTO_YEAR = 2015
+
+
+def read_term_list(list_path):
+    """
+    [(term_id, term)...] from a list with one term per line (ids from 1
+    in the order of the lines) or with "id<tab>term" lines
+    """
+    terms = []
+    fh = open(list_path, 'r')
+    for i, line in enumerate(fh):
+        line = line.rstrip('\r\n')
+        if not len(line.strip()):
+            continue
+        if "\t" in line:
+            (term_id, term) = line.split("\t")[0:2]
+            terms.append((int(term_id), term))
+        else:
+            terms.append((i + 1, line))
+    fh.close()
+    return terms
+
+
+def crawl_file_name(term_id, term):
+    """
+    same as the bash loop: padded id + term with \\W+ => '_'
+    (and a trailing '_' for the line end that echo gave to perl)
+    ex: (42, "sea level") => 0042-sea_level_.json
+    """
+    return "%04d-%s.json" % (term_id, sub(r'\W+', '_', term + "\n"))
+
+
+def crawl_path(outdir, term_id, term, shard_size = None):
+    "with shard_size, in subdirs of shard_size ids (outdir/0000/, outdir/0001/...)"
+    if shard_size:
+        outdir = path.join(outdir, "%04d" % (term_id // shard_size))
+    return path.join(outdir, crawl_file_name(term_id, term))
+
+
+def check_wos(result):
+    "raises KeyError/TypeError if the json isn't a wos histogram response"
+    if not isinstance(result['aggs']['publicationCount']['buckets'], list):
+        raise TypeError("buckets aren't a list")
+
+
+def is_valid_crawl(json_path):
+    "True if the file exists and holds a wos histogram response"
+    try:
+        with open(json_path, 'r') as fh:
+            check_wos(load(fh))
+        return True
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+
+def write_json_atomic(json_path, result):
+    "(a crash leaves no half-written file)"
+    makedirs(path.dirname(json_path) or '.', exist_ok=True)
+    tmp_path = json_path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        dump(result, fh)
+    replace(tmp_path, json_path)
+
+
+def crawl_terms(terms, outdir, api_url, since, until, client,
+                shard_size = None, verbose = False):
+    """
+    queries and writes all the terms that don't have a valid file yet
+
+    returns (n written, n skipped, [failed terms])
+    """
+    to_crawl = []
+    for term_id, term in terms:
+        json_path = crawl_path(outdir, term_id, term, shard_size)
+        if not is_valid_crawl(json_path):
+            to_crawl.append((term_id, term, json_path))
+    n_skipped = len(terms) - len(to_crawl)
+
+    print("%i terms: %i already crawled, %i to query"
+            % (len(terms), n_skipped, len(to_crawl)), file=stderr)
+
+    def crawl_one(job):
+        (term_id, term, json_path) = job
+        params = {'q[]': '"%s"' % term.lower(), 'since': since, 'until': until}
+        result = client.get_json(api_url, params, check_wos,
+                                 "%04d '%s'" % (term_id, term))
+        if result is not None:
+            write_json_atomic(json_path, result)
+        return result is not None
+
+    n_written = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=client.max_concurrency) as pool:
+        futures = {pool.submit(crawl_one, job): job for job in to_crawl}
+        for i, future in enumerate(as_completed(futures)):
+            if future.result():
+                n_written += 1
+            else:
+                failed.append(futures[future][0:2])
+            if verbose and (i + 1) % 100 == 0:
+                print("%i/%i" % (i + 1, len(to_crawl)), file=stderr)
+
+    return (n_written, n_skipped, sorted(failed))
+
+
+if __name__ == '__main__':
+    # cli args
+    # --------
+    parser = ArgumentParser(
+        description="Crawl the yearly histogram (wos api) of each term of a list into one json per term, with concurrent queries and resume",
+        epilog="-----(© 2016 ISCPIF-CNRS romain.loth at iscpif dot fr )-----")
+
+    parser.add_argument('-l',
+        metavar='pathto/terms.ls',
+        help='the term list: one term per line, or "id<tab>term" lines',
+        required=True,
+        action='store')
+
+    parser.add_argument('-o',
+        metavar='pathto/outdir',
+        default=DEFAULT_OUTDIR,
+        help='dir for the json files (default: %s)' % DEFAULT_OUTDIR,
+        required=False,
+        action='store')
+
+    parser.add_argument('--url',
+        metavar=DEFAULT_API_URL,
+        default=DEFAULT_API_URL,
+        help='the histogram api',
+        required=False,
+        action='store')
+
+    parser.add_argument('--since',
+        metavar='%i' % FROM_YEAR,
+        type=int,
+        default=FROM_YEAR,
+        help='first year (default: %i)' % FROM_YEAR,
+        required=False,
+        action='store')
+
+    parser.add_argument('--until',
+        metavar='%i' % UPTO_YEAR,
+        type=int,
+        default=UPTO_YEAR,
+        help='last year (default: %i)' % UPTO_YEAR,
+        required=False,
+        action='store')
+
+    parser.add_argument('--concurrency',
+        metavar='%i' % DEFAULT_CONCURRENCY,
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help='max number of simultaneous queries, adapted to the api by the client (default: %i)' % DEFAULT_CONCURRENCY,
+        required=False,
+        action='store')
+
+    parser.add_argument('--maxRate',
+        metavar='req/s',
+        type=float,
+        default=None,
+        help='max number of queries per second (default: no limit)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--maxRetries',
+        metavar='%i' % PARAM_MAX_RETRIES,
+        type=int,
+        default=PARAM_MAX_RETRIES,
+        help='retries of a failed query before giving up on it (default: %i)' % PARAM_MAX_RETRIES,
+        required=False,
+        action='store')
+
+    parser.add_argument('--maxDowntime',
+        metavar='%i' % PARAM_MAX_DOWNTIME,
+        type=float,
+        default=PARAM_MAX_DOWNTIME,
+        help='seconds the api can look down (open circuit breaker) before all the pending queries give up (default: %i)' % PARAM_MAX_DOWNTIME,
+        required=False,
+        action='store')
+
+    parser.add_argument('--shardSize',
+        metavar='1000',
+        type=int,
+        default=None,
+        help='write the files in subdirs of N ids each (outdir/0000/, outdir/0001/...) instead of one flat dir',
+        required=False,
+        action='store')
+
+    parser.add_argument('--verbose',
+        default=False,
+        help='more runtime logs',
+        required=False,
+        action='store_true')
+
+    args = parser.parse_args(argv[1:])
+
+    try:
+        terms = read_term_list(args.l)
+    except (OSError, ValueError) as e:
+        print("ERR: can't read the term list (%s)" % e, file=stderr)
+        exit(1)
+
+    client = ApiClient(args.concurrency, args.maxRetries, args.maxRate,
+                       user_agent=DEFAULT_USER_AGENT, verbose=args.verbose,
+                       max_downtime=args.maxDowntime)
+
+    (n_written, n_skipped, failed) = crawl_terms(
+                                        terms, args.o, args.url,
+                                        args.since, args.until, client,
+                                        args.shardSize, args.verbose)
+    client.close()
+
+    print("crawled: %i, already there: %i, failed: %i"
+            % (n_written, n_skipped, len(failed)), file=stderr)
+    for term_id, term in failed:
+        print("FAILED %04d\t%s" % (term_id, term), file=stderr)
+
+    # a rerun will only retry the failed terms
+    if len(failed):
+        exit(2)
@@ -1,3 +1,5 @@
+# (superseded by get_terms_yearly_aggs.py: same files, with concurrent queries,
+#  validated responses and resume)
 mkdir -p newcrawled
 i=0
 cat terms-5042.ls | while read line ;
@@ -3,6 +3,12 @@
 Read a [nodeid - val] tsv table
 and introduce the val as a node
 attribute in a gexf
+
+Or a tsv with a header [nodeid - attr1 - attr2...] to introduce
+many attributes at once (types inferred or given per column)
+
+The gexf is rewritten in one streaming pass (memory ~ one node,
+cf. gexf_model.py)
 """
 __author__    = "Romain Loth"
 __copyright__ = "Copyright 2016 ISCPIF-CNRS"
@@ -12,29 +18,174 @@ __email__     = "romain.loth@iscpif.fr"
 __status__    = "dev"
 
 from argparse import ArgumentParser
-from sys      import argv, stderr
-from lxml     import etree
+from sys      import argv, stderr, stdout
 from re       import sub
 
+from gexf_model import (
+    Column, attvalues_index, upsert_node_attvalue, stream_rewrite_gexf
+)
+
+
+# tsv column types => gexf attribute types
+# (int columns with values beyond 32 bits are declared as 'long')
+COLUMN_TYPES = {'int': 'integer', 'float': 'float', 'string': 'string'}
+INT32_MAX = 2**31 - 1
+
+
+def normalize_attr_name(name):
+    "ex: 'growth rate (%)' => 'growth_rate'"
+    name = sub(r'\W+', '_', name)
+    name = sub(r'^_+', '', name)
+    return sub(r'_+$', '', name)
+
+
+def column_type_of(value, current_type):
+    "the narrowest type among int < float < string for all values so far"
+    if current_type == 'int':
+        try:
+            int(value)
+            return 'int'
+        except ValueError:
+            current_type = 'float'
+    if current_type == 'float':
+        try:
+            float(value)
+            return 'float'
+        except ValueError:
+            pass
+    return 'string'
+
+
+class AttributeTable:
+    """
+    A tsv of node values, stored by column:
+      - ids:       the node ids (row order)
+      - row_of_id: {nodeid: row}
+      - names, types: the attribute names and their types (int/float/string)
+      - columns:   one gexf_model.Column per attribute ('q' array for int,
+                   'd' array for float, a list for strings) where the
+                   empty/bad values are missing
+    """
+    def __init__(self, names, types):
+        self.names = names
+        self.types = types
+        self.ids = []
+        self.row_of_id = {}
+        self.columns = [Column(column_type) for column_type in types]
+
+    def __len__(self):
+        return len(self.row_of_id)
+
+    def append(self, nodeid, values):
+        row = len(self.ids)
+        self.ids.append(nodeid)
+        self.row_of_id[nodeid] = row
+        for column, value in zip(self.columns, values):
+            if not len(value):
+                column.append(None)
+                continue
+            try:
+                column.append(column.parse(value))
+            except ValueError:
+                column.append(None)
+
+    def gexf_declarations(self):
+        "[(attr_id, gexf type)...]"
+        declarations = []
+        for j, name in enumerate(self.names):
+            gexf_type = COLUMN_TYPES[self.types[j]]
+            column = self.columns[j]
+            if (self.types[j] == 'int' and column.n_missing() < len(column)
+                and max(abs(v) for v in column.values) > INT32_MAX):
+                gexf_type = 'long'
+            declarations.append((name, gexf_type))
+        return declarations
+
+    def node_values(self, nodeid):
+        "[(attr_id, value)...] for a node id (None if it's not in the table)"
+        row = self.row_of_id.get(nodeid)
+        if row is None:
+            return None
+        return [(name, self.columns[j].values[row])
+                for j, name in enumerate(self.names)
+                if self.columns[j].present[row]]
+
+
+def read_attribute_table(tsv_path, names = None, types = {}):
+    """
+    Reads a tsv with node ids in the first column and values in the others
+
+      names: the attribute names (then the tsv has no header)
+             if None, they're read from the header line
+      types: {attr_name: 'int'|'float'|'string'} for some columns,
+             the others are inferred from their values
+
+    Two passes on the file: types inference then storage
+    """
+    tsv_fh = open(tsv_path, 'r')
+    has_header = names is None
+    if has_header:
+        header = tsv_fh.readline().rstrip('\r\n').split("\t")
+        names = [normalize_attr_name(name) for name in header[1:]]
+    n_cols = len(names) + 1
+
+    # 1st pass: inference for the types that weren't given
+    column_types = [types.get(name) for name in names]
+    to_infer = [j for j, t in enumerate(column_types) if t is None]
+    inferred = {j: 'int' for j in to_infer}
+    for line in tsv_fh:
+        cells = line.rstrip('\r\n').split("\t")
+        if len(cells) != n_cols:
+            continue
+        for j in to_infer:
+            value = cells[j+1]
+            if len(value) and inferred[j] != 'string':
+                inferred[j] = column_type_of(value, inferred[j])
+    for j in to_infer:
+        column_types[j] = inferred[j]
+
+    # 2nd pass: columnar storage
+    table = AttributeTable(names, column_types)
+    tsv_fh.seek(0)
+    for i, line in enumerate(tsv_fh):
+        if has_header and i == 0:
+            continue
+        line = line.rstrip('\r\n')
+        cells = line.split("\t")
+        if len(cells) != n_cols:
+            print('WARN skip tsv line %i ("%s")' % (i, line), file=stderr)
+            continue
+        table.append(cells[0], cells[1:])
+    tsv_fh.close()
+
+    for j, name in enumerate(names):
+        n_missing = table.columns[j].n_missing()
+        if n_missing:
+            print('WARN %i empty or invalid values for %s'
+                  % (n_missing, name), file=stderr)
+
+    return table
+
+
 if __name__ == '__main__':
     # cli args
     # --------
     parser = ArgumentParser(
-        description="Read a [nodeid - val] tsv table and introduce the val as a node attribute in a gexf",
+        description="Read a [nodeid - val] tsv table (or a [nodeid - val1 - val2...] tsv with a header) and introduce the vals as node attributes in a gexf",
         epilog="-----(© 2016 ISCPIF-CNRS romain.loth at iscpif dot fr )-----")
 
     parser.add_argument('-t',
         metavar='pathto/table.tsv',
-        help='input table, with 2 columns: nodeid value',
+        help='input table, with 2 columns: nodeid value (or with -n omitted: a header line nodeid attr1 attr2... and as many columns)',
         # default=DEFAULT_BUCKETS_JSON_DIR,
         required=True,
         action='store')
 
     parser.add_argument('-n',
         metavar='new_attribute_tagname',
-        help='name for the new attribute',
+        help='name for the new attribute (if absent, the names are read from the table header)',
         # default=DEFAULT_BUCKETS_JSON_DIR,
-        required=True,
+        required=False,
         action='store')
 
     parser.add_argument('-g',
@@ -43,61 +194,51 @@ if __name__ == '__main__':
         required=False,
         action='store')
 
+    parser.add_argument('--types',
+        metavar='attr1:int,attr2:string',
+        help='types of some columns among %s (default: inferred from the values, float with -n)' % "/".join(COLUMN_TYPES),
+        required=False,
+        action='store')
+
     args = parser.parse_args(argv[1:])
 
-    # normalize name of the new attribute
-    new_attr_name = sub(r'\W+', '_', args.n)
-    new_attr_name = sub(r'^_+', '', new_attr_name)
-    new_attr_name = sub(r'_+$', '', new_attr_name)
+    # types of the columns
+    col_types = {}
+    if args.types:
+        for type_spec in args.types.split(','):
+            (col_name, _, col_type) = type_spec.rpartition(':')
+            if col_type not in COLUMN_TYPES:
+                print("ERR: unknown type '%s' (choose among %s)"
+                      % (col_type, ", ".join(COLUMN_TYPES)), file=stderr)
+                exit(1)
+            col_types[normalize_attr_name(col_name)] = col_type
 
     # read input table
-    vals_per_id = {}
-    table_fh = open(args.t, 'r')
-    for i, line in enumerate(table_fh):
-        line = line.rstrip()
-        try:
-            (nodeid, value) = line.split("\t")
-            # print(nodeid, value)
-            vals_per_id[str(nodeid)] = float(value)
-        except:
-            print('WARN skip tsv line %i ("%s")' % (i, line), file=stderr)
-    table_fh.close()
-
-    # debug print whole dict
-    # print(vals_per_id)
-
-    # read input xml graph
-    xml_tree = etree.parse(args.g)
-
-    # prepare corresponding namespace
-    my_ns = {"g":"http://www.gexf.net/1.3"}
-
-    # add once the attribute declaration
-    attrs_declaration = xml_tree.xpath('/g:gexf/g:graph/g:attributes[@class="node"]', namespaces=my_ns).pop()
-    new_attr_declaration = etree.Element("attribute")
-    new_attr_declaration.attrib['id']    = new_attr_name
-    new_attr_declaration.attrib['title'] = new_attr_name
-    new_attr_declaration.attrib['type']  = "float"
-    attrs_declaration.append(new_attr_declaration)
-
-    # get all nodes by xpath
-    nodes = xml_tree.xpath('/g:gexf/g:graph/g:nodes/g:node', namespaces=my_ns)
-
-    # insert value in each nodes' xml
-    for node in nodes:
-        this_node_id = node.attrib['id']
-        current_attrs = node.xpath('g:attvalues', namespaces=my_ns).pop()
-
-        # the fragment to add
-        # -------------------
-        # ex: <attvalue for="bidule" value="5.32">
-        new_attr = etree.Element("attvalue")
-        new_attr.attrib['for'] = new_attr_name
-        new_attr.attrib['value'] = str(vals_per_id[this_node_id])
-
-        # add in this node
-        current_attrs.append(new_attr)
-
-
-    # print resulting XML to STDOUT
-    print(etree.tostring(xml_tree, pretty_print=True).decode('UTF-8'))
+    if args.n:
+        # normalize name of the new attribute
+        new_attr_name = normalize_attr_name(args.n)
+        col_types.setdefault(new_attr_name, 'float')
+        table = read_attribute_table(args.t, [new_attr_name], col_types)
+    else:
+        table = read_attribute_table(args.t, None, col_types)
+
+    # insert (or update) values in each nodes' xml
+    stat_n_missing_ids = [0]
+    stat_values = {'added': 0, 'updated': 0, 'unchanged': 0}
+    def add_values(node):
+        node_values = table.node_values(node.attrib['id'])
+        if node_values is None:
+            stat_n_missing_ids[0] += 1
+            return
+        index = attvalues_index(node)
+        for attr_name, value in node_values:
+            stat_values[upsert_node_attvalue(node, attr_name, value, index)] += 1
+
+    # read input xml graph and write resulting XML to STDOUT
+    stream_rewrite_gexf(args.g, stdout.buffer,
+                        table.gexf_declarations(), add_values)
+
+    if stat_n_missing_ids[0]:
+        print('Missing ids: %i' % stat_n_missing_ids[0], file=stderr)
+    print('Values added: %(added)i, updated: %(updated)i, unchanged: %(unchanged)i'
+          % stat_values, file=stderr)
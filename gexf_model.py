@@ -0,0 +1,574 @@
+#! /usr/bin/python3
+"""
+Shared gexf access for the scripts of this dir
+
+ - streaming helpers: upsert of the node attribute declarations and of
+   the node attvalues, rewrite of a gexf in one pass (stream_rewrite_gexf),
+   read of the top-level nodes up to </nodes> (iter_top_level_nodes,
+   iter_node_labels)
+ - GexfGraph: the nodes of a gexf in compact columns (ids, labels and one
+   array per attribute) with O(1) lookup by id or label, written back in
+   one streaming pass over the source gexf (the edges are never loaded)
+
+Works for gexf 1.2 and 1.3 (the namespace of the source is kept)
+"""
+__author__    = "Romain Loth"
+__copyright__ = "Copyright 2017 ISCPIF-CNRS"
+__license__   = "LGPL"
+__version__   = "1"
+__email__     = "romain.loth@iscpif.fr"
+__status__    = "dev"
+
+from sys      import stderr
+from lxml     import etree
+from array    import array
+from xml.sax.saxutils import quoteattr
+
+# gexf elements that we open/close around the streamed items, with their depth
+# (everything else is written as a whole subtree: meta, attributes, node...)
+GEXF_CONTAINERS = {'gexf': 0, 'graph': 1, 'nodes': 2, 'edges': 2}
+
+
+def localname(elem):
+    return elem.tag.rpartition('}')[2]
+
+
+def drop_blank_text(elem):
+    "(whitespace text in a parent would prevent the pretty_print of its children)"
+    if elem.text is not None and not elem.text.strip():
+        elem.text = None
+
+
+# an attvalue with one of these is a dynamic value (several per attribute)
+DYNAMIC_ATTVALUE_KEYS = ('start', 'end', 'startopen', 'endopen')
+
+
+def declarations_index(attributes):
+    """
+    {attr_id: <attribute>} of an <attributes> element
+
+    (the duplicate declarations of previous appending runs are removed)
+    """
+    index = {}
+    for attr in list(attributes.iterchildren('{*}attribute')):
+        attr_id = attr.get('id')
+        if attr_id in index:
+            attributes.remove(attr)
+        else:
+            index[attr_id] = attr
+    return index
+
+
+def upsert_attribute_declaration(parent, attr_id, attr_type, title = None,
+                                 index = None):
+    """
+    <attribute> in an <attributes> parent (in its namespace),
+    updated in place if it's already declared, new otherwise
+    ex: <attribute id="growth_rate" title="growth_rate" type="float"/>
+
+    index: the declarations_index() of the parent (computed if None)
+    """
+    if index is None:
+        index = declarations_index(parent)
+
+    attr_declaration = index.get(attr_id)
+    if attr_declaration is None:
+        drop_blank_text(parent)
+        attr_declaration = etree.SubElement(parent,
+                                            etree.QName(parent, 'attribute'))
+        attr_declaration.attrib['id'] = attr_id
+        index[attr_id] = attr_declaration
+    attr_declaration.attrib['title'] = title if title else attr_id
+    attr_declaration.attrib['type']  = attr_type
+    return attr_declaration
+
+
+def attvalues_index(node):
+    """
+    (<attvalues> of the node (created if needed), {attr_id: <attvalue>})
+
+    only for the static values (no start/end), and the duplicates of
+    previous appending runs are removed
+    """
+    current_attrs = node.find('{*}attvalues')
+    if current_attrs is None:
+        current_attrs = etree.SubElement(node, etree.QName(node, 'attvalues'))
+
+    index = {}
+    for attvalue in list(current_attrs.iterchildren('{*}attvalue')):
+        if any(key in attvalue.attrib for key in DYNAMIC_ATTVALUE_KEYS):
+            continue
+        attr_id = attvalue.get('for')
+        if attr_id in index:
+            current_attrs.remove(attvalue)
+        else:
+            index[attr_id] = attvalue
+    return (current_attrs, index)
+
+
+def upsert_node_attvalue(node, attr_id, value, index = None):
+    """
+    <attvalue> in the <attvalues> of a node, updated in place if the
+    node already has one for attr_id, new otherwise
+    ex: <attvalue for="bidule" value="5.32">
+
+    index: the attvalues_index() of the node (computed if None)
+
+    returns 'added', 'updated' or 'unchanged'
+    """
+    if index is None:
+        index = attvalues_index(node)
+    (current_attrs, attvalue_of) = index
+
+    value = str(value)
+    attvalue = attvalue_of.get(attr_id)
+    if attvalue is not None:
+        if attvalue.get('value') == value:
+            return 'unchanged'
+        attvalue.attrib['value'] = value
+        return 'updated'
+
+    drop_blank_text(current_attrs)
+    attvalue = etree.SubElement(current_attrs,
+                                etree.QName(current_attrs, 'attvalue'))
+    attvalue.attrib['for'] = attr_id
+    attvalue.attrib['value'] = value
+    attvalue_of[attr_id] = attvalue
+    return 'added'
+
+
+def qualified_name(name, nsmap, is_attribute = False):
+    "prefix:localname for a {uri}localname tag or attribute key"
+    qname = etree.QName(name)
+    if qname.namespace is None:
+        return qname.localname
+    for prefix, uri in nsmap.items():
+        if uri == qname.namespace and (prefix or not is_attribute):
+            return prefix + ':' + qname.localname if prefix else qname.localname
+    return qname.localname
+
+
+def ns_declarations(nsmap):
+    "the xmlns attributes for an nsmap, as bytes"
+    return [(' %s=%s' % ('xmlns:' + prefix if prefix else 'xmlns',
+                         quoteattr(uri))).encode('UTF-8')
+            for prefix, uri in nsmap.items()]
+
+
+def start_tag(elem, with_nsmap = False):
+    "the serialized open tag of an element (without its children)"
+    parts = [qualified_name(elem.tag, elem.nsmap)]
+    if with_nsmap:
+        parts.extend(d.decode('UTF-8').lstrip()
+                     for d in ns_declarations(elem.nsmap))
+    for key, value in elem.attrib.items():
+        parts.append('%s=%s' % (qualified_name(key, elem.nsmap, True),
+                                quoteattr(value)))
+    return ('<%s>\n' % ' '.join(parts)).encode('UTF-8')
+
+
+def end_tag(elem):
+    return ('</%s>\n' % qualified_name(elem.tag, elem.nsmap)).encode('UTF-8')
+
+
+def serialize_item(elem, root_declarations):
+    """
+    an element with its subtree, minus the namespace declarations
+    that it inherits from the (already written) <gexf> root tag
+    """
+    serialized = etree.tostring(elem, encoding='UTF-8', pretty_print=True)
+    first_tag_end = serialized.index(b'>')
+    first_tag = serialized[:first_tag_end]
+    for declaration in root_declarations:
+        first_tag = first_tag.replace(declaration, b'', 1)
+    return first_tag + serialized[first_tag_end:]
+
+
+def stream_rewrite_gexf(gexf_path, out_fh, new_declarations, node_callback):
+    """
+    Rewrites a gexf with iterparse in one pass:
+      - new_declarations: [(attr_id, type)...] or [(attr_id, type, title)...]
+                          upserted in the node <attributes> (created if
+                          there are none)
+      - node_callback(node): called on each top-level <node> element
+                             before it's written (can modify it in-place)
+
+    The containers (gexf, graph, nodes, edges) are written tag by tag and
+    the items under them (meta, attributes, node, edge) one by one as soon
+    as they've been read, then freed: the memory stays bounded by one node.
+    """
+    declared = False
+    root_nsmap = {}
+    root_declarations = []
+
+    out_fh.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+
+    # the opened containers
+    opened = []
+
+    for event, elem in etree.iterparse(gexf_path,
+                                       events=('start', 'end'),
+                                       remove_blank_text=True,
+                                       remove_comments=True):
+        if event == 'start':
+            # containers: just the open tag (they're at depth <= 2)
+            if len(opened) > 2:
+                continue
+            name = localname(elem)
+            if GEXF_CONTAINERS.get(name) != len(opened):
+                continue
+
+            # no node attributes declared so far: we create them
+            if name == 'nodes' and not declared:
+                if len(new_declarations):
+                    attrs = etree.Element(etree.QName(elem, 'attributes'),
+                                          {'class': 'node'},
+                                          nsmap=root_nsmap)
+                    for declaration in new_declarations:
+                        upsert_attribute_declaration(attrs, *declaration)
+                    out_fh.write(serialize_item(attrs, root_declarations))
+                declared = True
+
+            if not len(opened):
+                root_nsmap = dict(elem.nsmap)
+                root_declarations = ns_declarations(root_nsmap)
+                out_fh.write(start_tag(elem, with_nsmap=True))
+            else:
+                out_fh.write(start_tag(elem))
+            opened.append(elem)
+
+        elif len(opened) and elem is opened[-1]:
+            # end of container
+            out_fh.write(end_tag(opened.pop()))
+
+        elif len(opened) and elem.getparent() is opened[-1]:
+            # end of an item directly under a container
+            name = localname(elem)
+            if name == 'attributes' and elem.get('class') == 'node':
+                index = declarations_index(elem)
+                for declaration in new_declarations:
+                    upsert_attribute_declaration(elem, *declaration,
+                                                 index=index)
+                declared = True
+            elif name == 'node':
+                node_callback(elem)
+
+            out_fh.write(serialize_item(elem, root_declarations))
+
+            # free memory: this item and the already seen siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+
+def iter_top_level_nodes(gexf_path, attributes_callback = None):
+    """
+    Yields the top-level <node> elements of a gexf (not the subnodes of
+    hierarchical graphs) with iterparse, each one freed once used
+
+    Stops at the end of the top-level <nodes>: the edges aren't parsed
+    (NB: iterparse would build them into the tree even with a tag filter)
+
+    attributes_callback(elem): called on each <attributes> of the graph
+    """
+    for event, elem in etree.iterparse(gexf_path, events=('end',),
+                                       tag=('{*}attributes', '{*}nodes',
+                                            '{*}node')):
+        parent = elem.getparent()
+        name = localname(elem)
+        if name == 'nodes':
+            if localname(parent) == 'graph':
+                break
+        elif name == 'attributes':
+            if localname(parent) == 'graph' and attributes_callback is not None:
+                attributes_callback(elem)
+        elif (localname(parent) == 'nodes'
+              and localname(parent.getparent()) == 'graph'):
+            yield elem
+
+            # free memory: this node and the already seen siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+
+def iter_node_labels(gexf_path):
+    "the label of each top-level node (None if it has none)"
+    for node in iter_top_level_nodes(gexf_path):
+        yield node.get('label')
+
+
+# gexf attribute types => storage of their column (the others are strings)
+COLUMN_KINDS = {'integer': 'int', 'long': 'int', 'float': 'float',
+                'double': 'float'}
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+
+
+class Column:
+    """
+    The values of one attribute for all the nodes (row order):
+      - kind:    'int' (values in an array('q')), 'float' (array('d'))
+                 or 'string' (a list)
+      - present: 1 for the rows that have a value, 0 for the missing ones
+    """
+    __slots__ = ('kind', 'values', 'present')
+
+    def __init__(self, kind, n_rows = 0):
+        self.kind = kind
+        if kind == 'int':
+            self.values = array('q', bytes(8 * n_rows))
+        elif kind == 'float':
+            self.values = array('d', bytes(8 * n_rows))
+        else:
+            self.values = [None] * n_rows
+        self.present = bytearray(n_rows)
+
+    def __len__(self):
+        return len(self.present)
+
+    def parse(self, text):
+        "text => value of the column kind (raises ValueError)"
+        if self.kind == 'int':
+            value = int(text)
+            if not INT64_MIN <= value <= INT64_MAX:
+                raise ValueError("%s doesn't fit in 64 bits" % text)
+            return value
+        elif self.kind == 'float':
+            return float(text)
+        return text
+
+    def append(self, value):
+        "value of the column kind, or None if missing"
+        if value is None:
+            self.values.append(0 if self.kind != 'string' else None)
+            self.present.append(0)
+        else:
+            self.values.append(value)
+            self.present.append(1)
+
+    def get(self, row):
+        return self.values[row] if self.present[row] else None
+
+    def set(self, row, value):
+        if value is None:
+            self.present[row] = 0
+        else:
+            self.values[row] = value
+            self.present[row] = 1
+
+    def n_missing(self):
+        return self.present.count(0)
+
+    def to_list(self):
+        "all the values, None for the missing ones"
+        return [value if is_present else None
+                for value, is_present in zip(self.values, self.present)]
+
+
+class GexfGraph:
+    """
+    The top-level nodes of a gexf, stored by column:
+      - ids, labels:  lists in the document order (= row order)
+      - row_of_id:    {nodeid: row}
+      - row_of_label: {label: row} (the first node for a shared label)
+      - declarations: {attr_id: (gexf type, title)} of the node attributes
+      - columns:      {attr_id: Column}
+      - changed:      the attr_ids set since the loading
+
+    Only these are kept in memory: write() reads the source gexf again
+    and streams it with the changed attributes (edges, viz, meta... are
+    copied as they are)
+
+    ex: graph = GexfGraph("graph.gexf", attr_names=['weight'])
+        graph.set('rank', {'n1': 3, 'n2': 1}, 'integer')
+        graph.write(stdout.buffer)
+    """
+    def __init__(self, gexf_path, attr_names = None, typed = True):
+        """
+        attr_names: the attributes to load (by id or title), None for all
+        typed:      False keeps the values as their gexf text (for exact
+                    copies), otherwise the numeric types are parsed
+        """
+        self.gexf_path = gexf_path
+        self.ids = []
+        self.labels = []
+        self.row_of_id = {}
+        self.row_of_label = {}
+        self.declarations = {}
+        self.columns = {}
+        self.changed = []
+        self._load(attr_names, typed)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _load(self, attr_names, typed):
+        "one pass over the top-level nodes (cf. iter_top_level_nodes)"
+        # the attr_ids to load (known once we've read the declarations)
+        wanted_ids = None
+        invalid = {}
+
+        def read_declarations(attributes):
+            if attributes.get('class') != 'node':
+                return
+            for attr in attributes.iterchildren('{*}attribute'):
+                attr_id = attr.get('id')
+                title = attr.get('title', attr_id)
+                if (attr_id not in self.declarations
+                    and (attr_names is None or attr_id in attr_names
+                         or title in attr_names)):
+                    self.declare(attr_id, attr.get('type', 'string'),
+                                 title, None if typed else 'string')
+
+        for elem in iter_top_level_nodes(self.gexf_path, read_declarations):
+            if wanted_ids is None:
+                wanted_ids = set(self.declarations)
+                # undeclared but asked for: legacy gexf with only attvalues
+                titles = {title for _, title in self.declarations.values()}
+                for attr_name in (attr_names or []):
+                    if attr_name not in wanted_ids and attr_name not in titles:
+                        self.declare(attr_name, 'string')
+                        wanted_ids.add(attr_name)
+
+            node_vals = {}
+            for attvalue in elem.iterfind('{*}attvalues/{*}attvalue'):
+                if any(key in attvalue.attrib for key in DYNAMIC_ATTVALUE_KEYS):
+                    continue
+                attr_id = attvalue.get('for')
+                if attr_id not in wanted_ids:
+                    # undeclared and no filter: kept as strings
+                    if attr_names is not None:
+                        continue
+                    self.declare(attr_id, 'string')
+                    wanted_ids.add(attr_id)
+                column = self.columns[attr_id]
+                try:
+                    node_vals.setdefault(attr_id,
+                                         column.parse(attvalue.get('value')))
+                except ValueError:
+                    invalid[attr_id] = invalid.get(attr_id, 0) + 1
+
+            self._append_node(elem.get('id'), elem.get('label'), node_vals)
+
+        for attr_id, n_invalid in invalid.items():
+            print('WARN %i invalid values for %s (%s) in %s'
+                  % (n_invalid, attr_id, self.declarations[attr_id][0],
+                     self.gexf_path), file=stderr)
+
+    def _append_node(self, nodeid, label, node_vals):
+        row = len(self.ids)
+        self.ids.append(nodeid)
+        self.labels.append(label)
+        self.row_of_id.setdefault(nodeid, row)
+        self.row_of_label.setdefault(label, row)
+        for attr_id, column in self.columns.items():
+            column.append(node_vals.get(attr_id))
+
+    def declare(self, attr_id, attr_type, title = None, kind = None):
+        """
+        (re)declares a node attribute, with an empty column if it's new
+
+        kind: storage of the values (default: after the gexf type)
+        """
+        self.declarations[attr_id] = (attr_type, title if title else attr_id)
+        if attr_id not in self.columns:
+            if kind is None:
+                kind = COLUMN_KINDS.get(attr_type, 'string')
+            self.columns[attr_id] = Column(kind, len(self.ids))
+        return self.columns[attr_id]
+
+    def row(self, nodeid):
+        "the row of a node id (None if it's not in the graph)"
+        return self.row_of_id.get(nodeid)
+
+    def row_by_label(self, label):
+        return self.row_of_label.get(label)
+
+    def get(self, attr_id):
+        "all the values of an attribute in row order (None if missing)"
+        return self.columns[attr_id].to_list()
+
+    def get_value(self, nodeid, attr_id):
+        row = self.row_of_id.get(nodeid)
+        if row is None:
+            return None
+        return self.columns[attr_id].get(row)
+
+    def node_values(self, row):
+        "{attr_id: value} of a node (only the present values)"
+        return {attr_id: column.values[row]
+                    for attr_id, column in self.columns.items()
+                    if column.present[row]}
+
+    def set(self, attr_id, values, attr_type = None, title = None,
+            kind = None):
+        """
+        sets the values of an attribute (declared if it's new)
+
+        values:    one value per row, or {nodeid: value} for some nodes
+                   (None: the node keeps its current value)
+        attr_type: the gexf type (default: the current one, or string)
+        kind:      storage of the values (cf. declare), ex: 'string' for
+                   already formatted numbers
+
+        returns the number of ids of a dict that aren't in the graph
+        """
+        if attr_type is None:
+            attr_type = self.declarations.get(attr_id, ('string',))[0]
+            if title is None and attr_id in self.declarations:
+                title = self.declarations[attr_id][1]
+        column = self.declare(attr_id, attr_type, title, kind)
+        if attr_id not in self.changed:
+            self.changed.append(attr_id)
+
+        n_unknown = 0
+        if isinstance(values, dict):
+            for nodeid, value in values.items():
+                row = self.row_of_id.get(nodeid)
+                if row is None:
+                    n_unknown += 1
+                elif value is not None:
+                    column.set(row, value)
+        else:
+            if len(values) != len(self.ids):
+                raise ValueError("%i values for %i nodes"
+                                 % (len(values), len(self.ids)))
+            for row, value in enumerate(values):
+                if value is not None:
+                    column.set(row, value)
+        return n_unknown
+
+    def write(self, out_fh):
+        """
+        Streams the source gexf to out_fh (binary) with the changed
+        attributes upserted (cf. stream_rewrite_gexf)
+
+        returns stats {'added': n, 'updated': n, 'unchanged': n} of the
+        attvalues
+        """
+        declarations = [(attr_id,) + self.declarations[attr_id]
+                        for attr_id in self.changed]
+        changed_columns = [(attr_id, self.columns[attr_id])
+                           for attr_id in self.changed]
+        stats = {'added': 0, 'updated': 0, 'unchanged': 0}
+        next_row = [0]
+
+        def upsert_changed(node):
+            row = next_row[0]
+            next_row[0] += 1
+            if row >= len(self.ids) or node.get('id') != self.ids[row]:
+                raise ValueError("%s has changed since it was loaded"
+                                 % self.gexf_path)
+            index = None
+            for attr_id, column in changed_columns:
+                if column.present[row]:
+                    if index is None:
+                        index = attvalues_index(node)
+                    stats[upsert_node_attvalue(node, attr_id,
+                                               column.values[row], index)] += 1
+
+        stream_rewrite_gexf(self.gexf_path, out_fh, declarations,
+                            upsert_changed)
+        return stats
@@ -1,4 +1,6 @@
 # continuation for get_terms_yearly_aggs_loop
+# (superseded by many_json_buckets_to_one_csv.py: same output in one process,
+#  with the columns aligned on the years)
 
 ls | while read fnam ;
   do
@@ -0,0 +1,117 @@
+#! /usr/bin/python3
+"""
+Same table as many_json_buckets_to_one_csv.bash (id, label, one count
+per year) for a whole dir of crawled json, in one process
+
+The id and label come from the file names (ex: 0042-some_term_.json)
+and the counts are aligned by bucket key (0 for the missing years)
+"""
+__author__    = "Romain Loth"
+__copyright__ = "Copyright 2016 ISCPIF-CNRS"
+__license__   = "LGPL"
+__version__   = "1"
+__email__     = "romain.loth@iscpif.fr"
+__status__    = "dev"
+
+from argparse import ArgumentParser
+from sys      import argv, stderr, stdout
+from re       import sub
+from os       import path
+
+from many_json_buckets_to_one_table import (
+    FROM_YEAR, UPTO_YEAR, GRANULARITIES,
+    period_range, term_id_of, sorted_by_term_id, table_rows,
+    crawled_json_paths
+)
+
+
+def label_of(json_path):
+    """
+    the term of a crawled file name, as in the crawl loop (non-word
+    chars replaced by '_' and a trailing '_' for the line end)
+    ex: 0042-sea_level_.json => 'sea_level'
+    """
+    name = sub(r'\.json$', '', path.basename(json_path))
+    name = sub(r'^\d+-', '', name)
+    return sub(r'_$', '', name)
+
+
+if __name__ == '__main__':
+    # cli args
+    # --------
+    parser = ArgumentParser(
+        description="Paste all the crawled json histograms of a dir into one tsv: id, label, then one count per year",
+        epilog="-----(© 2016 ISCPIF-CNRS romain.loth at iscpif dot fr )-----")
+
+    parser.add_argument('-d',
+        metavar='pathto/jsondir',
+        default='.',
+        help='the dir with the json time buckets for each term (default: current dir)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--since',
+        metavar='%i' % FROM_YEAR,
+        default=str(FROM_YEAR),
+        help='first year of the table (default: %i)' % FROM_YEAR,
+        required=False,
+        action='store')
+
+    parser.add_argument('--until',
+        metavar='%i' % UPTO_YEAR,
+        default=str(UPTO_YEAR),
+        help='last year of the table, included (default: %i)' % UPTO_YEAR,
+        required=False,
+        action='store')
+
+    parser.add_argument('--granularity',
+        choices=list(GRANULARITIES),
+        default='year',
+        help='period of each column (cf. many_json_buckets_to_one_table.py, default: year)',
+        required=False,
+        action='store')
+
+    parser.add_argument('-j',
+        metavar='n_workers',
+        type=int,
+        help='number of parallel processes to read the json files (default: as many as CPUs)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--header',
+        default=False,
+        help='print a first line with the column names',
+        required=False,
+        action='store_true')
+
+    args = parser.parse_args(argv[1:])
+
+    json_paths = crawled_json_paths(args.d)
+    if not len(json_paths):
+        print("no files matching '*.json' were found under in directory '%s'"
+                % args.d,
+                file=stderr)
+        exit(1)
+
+    try:
+        all_periods = period_range(args.since, args.until, args.granularity)
+    except ValueError as e:
+        print("ERR: bad --since/--until (%s)" % e, file=stderr)
+        exit(1)
+
+    if args.header:
+        print("\t".join(['id', 'label'] + all_periods))
+
+    for json_path, counts in table_rows(sorted_by_term_id(json_paths),
+                                        all_periods, args.granularity, args.j):
+        if counts is None:
+            continue
+        term_id = term_id_of(json_path)
+        if term_id is None:
+            print("WARNING: skipping %s (no term id in the file name)"
+                  % json_path, file=stderr)
+            continue
+
+        # tsv output
+        stdout.write("%s\t%s\t%s\n" % (term_id, label_of(json_path),
+                                        "\t".join(map(str, counts))))
@@ -1,20 +1,25 @@
 #! /usr/bin/python3
 """
 Paste many elasticsearch aggregation buckets over same time period into one table
+
+Each json is read once into a {period: doc_count} index, the files are
+parsed in parallel and the rows are written in the order of the term ids
 """
 __author__    = "Romain Loth"
 __copyright__ = "Copyright 2016 ISCPIF-CNRS"
 __license__   = "LGPL"
-__version__   = "0.5"
+__version__   = "0.6"
 __email__     = "romain.loth@iscpif.fr"
 __status__    = "dev"
 
 from argparse import ArgumentParser
-from sys      import argv, stderr
+from sys      import argv, stderr, stdout
 from json     import load
 from glob     import glob
 from re       import search
 from os       import path
+from datetime import datetime, timedelta
+from multiprocessing import Pool
 
 DEFAULT_BUCKETS_JSON_DIR="/home/romain/tw/risk2015_scraps/recency/all_crawled"
 
@@ -22,11 +27,122 @@ DEFAULT_BUCKETS_JSON_DIR="/home/romain/tw/risk2015_scraps/recency/all_crawled"
 FROM_YEAR = 2000
 UPTO_YEAR = 2015
 
-all_years = [y for y in range(FROM_YEAR, UPTO_YEAR+1)]
+# periods of the table columns, as strftime formats of the period start
+GRANULARITIES = {'year': '%Y', 'month': '%Y-%m', 'day': '%Y-%m-%d'}
+
+# keys under this are years (wos), above they're epoch ms (ES date_histogram)
+MAX_YEAR_KEY = 10000
+
 
-# range +1 last value
-# exemple: range(2000,2016)
-# [2000, 2001, 2002, 2003, 2004, 2005, 2006, 2007, 2008, 2009, 2010, 2011, 2012, 2013, 2014, 2015]
+def read_buckets(json_path):
+    """
+    [(key, doc_count)...] of a crawled json, for the 2 api shapes:
+      - wos:     {"aggs": {"publicationCount": {"buckets": [{"key": 2000, "doc_count": 485}...]}}}
+      - twitter: {"results": {"hits": [{"key": 1483228800000, "doc_count": 7488103}...]}}
+    """
+    fh = open(json_path, "r")
+    all_json = load(fh)
+    fh.close()
+
+    if 'aggs' in all_json:
+        buckets = all_json['aggs']['publicationCount']['buckets']
+    else:
+        buckets = all_json['results']['hits']
+    return [(bk['key'], bk['doc_count']) for bk in buckets]
+
+
+def period_of(key, granularity = 'year'):
+    "the column of a bucket key (ex: 2015 => '2015', 1425168000000 => '2015-03')"
+    if isinstance(key, str):
+        key = int(key)
+    if key < MAX_YEAR_KEY:
+        if granularity != 'year':
+            raise ValueError("yearly bucket %i can't go in a %s column"
+                             % (key, granularity))
+        return str(key)
+    day = datetime(1970, 1, 1) + timedelta(milliseconds=key)
+    return day.strftime(GRANULARITIES[granularity])
+
+
+def period_range(since, until, granularity = 'year'):
+    """
+    all the periods from since to until included
+    (since and until like '2000', '2000-01' or '2000-01-01')
+    """
+    date_format = GRANULARITIES[granularity]
+    start = datetime.strptime((since + '-01-01')[:10], '%Y-%m-%d')
+    end = datetime.strptime((until + '-01-01')[:10], '%Y-%m-%d')
+
+    periods = []
+    while start <= end:
+        periods.append(start.strftime(date_format))
+        if granularity == 'year':
+            start = datetime(start.year + 1, 1, 1)
+        elif granularity == 'month':
+            start = datetime(start.year + start.month // 12,
+                             start.month % 12 + 1, 1)
+        else:
+            start += timedelta(days=1)
+    return periods
+
+
+def file_counts(json_path, granularity = 'year'):
+    "{period: doc_count} for one crawled json (summed by period)"
+    counts = {}
+    for key, doc_count in read_buckets(json_path):
+        period = period_of(key, granularity)
+        counts[period] = counts.get(period, 0) + doc_count
+    return counts
+
+
+def term_id_of(json_path):
+    "the id prefix of a crawled file name (ex: 0042-some_term.json => '0042')"
+    match = search(r'^\d+', path.basename(json_path))
+    return match.group() if match else None
+
+
+def crawled_json_paths(json_dir):
+    "the *.json of a dir and of its shard subdirs (cf. get_terms_yearly_aggs.py)"
+    return (glob(path.join(json_dir, "*.json"))
+            + glob(path.join(json_dir, "*", "*.json")))
+
+
+def sorted_by_term_id(json_paths):
+    "numeric order of the ids (then the file names), the files without id last"
+    def sort_key(json_path):
+        term_id = term_id_of(json_path)
+        return (term_id is None, int(term_id) if term_id else 0,
+                path.basename(json_path))
+    return sorted(json_paths, key=sort_key)
+
+
+def table_row(job):
+    """
+    (json_path, periods, granularity) => (json_path, [count per period])
+    or (json_path, None) if the file can't be read (for a worker process)
+    """
+    (json_path, periods, granularity) = job
+    try:
+        counts = file_counts(json_path, granularity)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("WARNING: skipping %s (%s)" % (json_path, e), file=stderr)
+        return (json_path, None)
+    return (json_path, [counts.get(period, 0) for period in periods])
+
+
+def table_rows(json_paths, periods, granularity = 'year', n_workers = None):
+    """
+    (json_path, counts) for each json, in the order of json_paths
+    (parsed in parallel by n_workers processes, default: as many as CPUs)
+    """
+    jobs = [(json_path, periods, granularity) for json_path in json_paths]
+    if n_workers == 1:
+        for job in jobs:
+            yield table_row(job)
+    else:
+        with Pool(n_workers) as pool:
+            for row in pool.imap(table_row, jobs, chunksize=64):
+                yield row
 
 
 if __name__ == '__main__':
@@ -43,53 +159,68 @@ if __name__ == '__main__':
         required=True,
         action='store')
 
+    parser.add_argument('--since',
+        metavar='%i' % FROM_YEAR,
+        default=str(FROM_YEAR),
+        help='first period of the table (ex: 2000 or 2017-01-01, default: %i)' % FROM_YEAR,
+        required=False,
+        action='store')
+
+    parser.add_argument('--until',
+        metavar='%i' % UPTO_YEAR,
+        default=str(UPTO_YEAR),
+        help='last period of the table, included (default: %i)' % UPTO_YEAR,
+        required=False,
+        action='store')
+
+    parser.add_argument('--granularity',
+        choices=list(GRANULARITIES),
+        default='year',
+        help='period of each column (month and day need epoch ms bucket keys like in the twitter api, default: year)',
+        required=False,
+        action='store')
+
+    parser.add_argument('-j',
+        metavar='n_workers',
+        type=int,
+        help='number of parallel processes to read the json files (default: as many as CPUs)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--header',
+        default=False,
+        help='print a first line with the column names',
+        required=False,
+        action='store_true')
+
     args = parser.parse_args(argv[1:])
 
-    buckets_paths = glob(args.d+"/*.json")
+    buckets_paths = crawled_json_paths(args.d)
     if not len(buckets_paths):
         print("no files matching '*.json' were found under in directory '%s'"
                 % args.d,
                 file=stderr)
         exit(1)
-    else:
-        # print("debug: just 3:", buckets_paths[0:3])
-        for bucket_path in buckets_paths:
-            term_id = search(r'^\d+',path.basename(bucket_path)).group()
-
-            output_vals = {} # year by year dict
-            output_line = term_id
-
-            # try:
-
-            fh = open(bucket_path, "r")
-            # json.load to read the data
-            all_json = load(fh)
-            fh.close()
-
-            # todo match in path
-            term_id = search("r'^\d+", bucket_path)
-
-            bucket_info = all_json['aggs']['publicationCount']['buckets']
-            # print(bucket_info)
-
-            # secondary loop to test for missing years :(
-            for year in all_years:
-                found = False
-                for i, bk in enumerate(bucket_info):
-                    if int(bk['key']) == year:
-                        found = i
-                        break
-                if found:
-                    output_vals[year] = bucket_info[found]['doc_count']
-                else:
-                    output_vals[year] = 0
-            # except Exception as e:
-            #     print("WARNING: term_id", term_id, "has error:", str(e) )
-            #     for year in all_years:
-            #         output_vals[year] = -1
-
-            # now the csv line
-            for year in all_years:
-                output_line += "\t"+ str(output_vals[year])
-
-            print(output_line)
+
+    try:
+        all_periods = period_range(args.since, args.until, args.granularity)
+    except ValueError as e:
+        print("ERR: bad --since/--until (%s)" % e, file=stderr)
+        exit(1)
+
+    if args.header:
+        print("\t".join(['id'] + all_periods))
+
+    for bucket_path, counts in table_rows(sorted_by_term_id(buckets_paths),
+                                          all_periods, args.granularity,
+                                          args.j):
+        if counts is None:
+            continue
+        term_id = term_id_of(bucket_path)
+        if term_id is None:
+            print("WARNING: skipping %s (no term id in the file name)"
+                  % bucket_path, file=stderr)
+            continue
+
+        # now the csv line
+        stdout.write(term_id + "\t" + "\t".join(map(str, counts)) + "\n")
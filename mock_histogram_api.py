@@ -0,0 +1,375 @@
+#! /usr/bin/python3
+"""
+Local stand-in for the iscpif histogram APIs, to test and benchmark
+the scripts that query them without hitting api.iscpif.fr
+
+Two response shapes, chosen by the path:
+  - .../wos/...  => like /1/wos/search/histogram.json (yearly buckets)
+     {"took": 11, "total": 11033,
+      "aggs": {"publicationCount": {"buckets": [{"key": 2000, "doc_count": 485}...]}},
+      "hits": {"total": 11033, "max_score": 0, "hits": []}}
+  - any other    => like /v2/pub/politic/france/twitter/histogram
+     {"results": {"hits": [{"key": 1483228800000,
+                            "key_as_string": "2017-01-01T00:00:00.000Z",
+                            "doc_count": 7488103}...],
+                  "took": 506, "total": 20538040}}
+
+The counts are a deterministic synthetic series for each term (same term
+and bucket => same doc_count), with a configurable latency, error rate
+and rate limit.
+"""
+__author__    = "Romain Loth"
+__copyright__ = "Copyright 2017 ISCPIF-CNRS"
+__license__   = "LGPL"
+__version__   = "1"
+__email__     = "romain.loth@iscpif.fr"
+__status__    = "dev"
+
+from argparse    import ArgumentParser
+from sys         import argv, stderr
+from json        import dumps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime    import datetime, timedelta
+from calendar    import timegm
+from math        import exp, sin, pi
+from zlib        import crc32
+from random      import random, uniform
+from threading   import Lock
+from time        import sleep, time
+
+DEFAULT_PORT = 8765
+
+# when the query has no since/until
+DEFAULT_SINCE = "2017-01-01"
+DEFAULT_UNTIL = "2017-03-31"
+DEFAULT_WOS_SINCE = 2000
+DEFAULT_WOS_UNTIL = 2015
+
+# query for the total volume
+TOTAL_QUERY = "*"
+
+
+##### deterministic synthetic series #####
+def unit_hash(*things):
+    "a stable pseudo-random float in [0,1) for any combination of things"
+    return crc32("|".join(str(t) for t in things).encode('UTF-8')) / 2**32
+
+
+def synthetic_count(term, day, n_days = 1):
+    """
+    doc_count for a term over n_days from day (a datetime)
+
+    each term gets its own level, yearly growth and weekly phase
+    """
+    term = term.strip('"').lower()
+    if term == TOTAL_QUERY:
+        level = 100000
+        growth = 0.1
+    else:
+        level = 1 + 200 * unit_hash(term, 'level') ** 3
+        growth = 1.5 * unit_hash(term, 'growth') - 0.5
+    phase = 2 * pi * unit_hash(term, 'phase')
+
+    years = (day - datetime(2000, 1, 1)).days / 365.25
+    weekly = 1
+    if n_days == 1:
+        weekly += 0.3 * sin(2 * pi * day.weekday() / 7 + phase)
+    noise = 0.8 + 0.4 * unit_hash(term, day.date())
+
+    return int(level * n_days * exp(growth * years / 10) * weekly * noise)
+
+
+# the accepted intervals (as prefixes, ex: 'week' or 'weeks')
+INTERVALS = ('day', 'week', 'month', 'quarter', 'year')
+
+
+def parse_date(date_string):
+    "'2017', '2017-03' or '2017-03-24' => datetime (raises ValueError)"
+    return datetime.strptime((date_string + '-01-01')[:10], '%Y-%m-%d')
+
+
+def date_buckets(since, until, interval):
+    """
+    (bucket start, n_days) between the since and until dates
+    aligned like ES date_histograms (weeks start on monday)
+
+    raises ValueError for a bad date or interval
+    """
+    if not interval.startswith(INTERVALS):
+        raise ValueError("unknown interval '%s'" % interval)
+    start = parse_date(since)
+    end = parse_date(until)
+
+    if interval.startswith('week'):
+        start -= timedelta(days=start.weekday())
+    elif interval.startswith('month'):
+        start = datetime(start.year, start.month, 1)
+    elif interval.startswith('quarter'):
+        start = datetime(start.year, start.month - (start.month - 1) % 3, 1)
+    elif interval.startswith('year'):
+        start = datetime(start.year, 1, 1)
+
+    buckets = []
+    while start <= end:
+        if interval.startswith('week'):
+            following = start + timedelta(days=7)
+        elif interval.startswith('month'):
+            following = datetime(start.year + start.month // 12,
+                                 start.month % 12 + 1, 1)
+        elif interval.startswith('quarter'):
+            following = datetime(start.year + (start.month + 2) // 12,
+                                 (start.month + 2) % 12 + 1, 1)
+        elif interval.startswith('year'):
+            following = datetime(start.year + 1, 1, 1)
+        else:
+            following = start + timedelta(days=1)
+        buckets.append((start, (following - start).days))
+        start = following
+    return buckets
+
+
+def twitter_histogram(terms, params):
+    "politic/twitter shape, one histogram (summed if several terms)"
+    since = params.get('since', [DEFAULT_SINCE])[0]
+    until = params.get('until', [DEFAULT_UNTIL])[0]
+    interval = params.get('interval', ['day'])[0]
+
+    hits = []
+    for start, n_days in date_buckets(since, until, interval):
+        count = sum(synthetic_count(term, start, n_days) for term in terms)
+        if count > 0:
+            hits.append({
+                'key': timegm(start.timetuple()) * 1000,
+                'key_as_string': start.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'doc_count': count
+            })
+    return hits
+
+
+def wos_histogram(terms, params):
+    "wos shape, one yearly histogram (summed if several terms)"
+    since = parse_date(params.get('since', [str(DEFAULT_WOS_SINCE)])[0]).year
+    until = parse_date(params.get('until', [str(DEFAULT_WOS_UNTIL)])[0]).year
+    return [
+        {'key': year,
+         'doc_count': sum(synthetic_count(term, datetime(year, 1, 1), 365)
+                            for term in terms) // 50}
+        for year in range(since, until + 1)
+    ]
+
+
+##### server #####
+class RateLimiter:
+    "token bucket: max_rate requests per second (+ a burst of max_rate)"
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.tokens = max_rate
+        self.last = time()
+        self.lock = Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time()
+            self.tokens = min(self.max_rate,
+                              self.tokens + (now - self.last) * self.max_rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class MockHistogramHandler(BaseHTTPRequestHandler):
+    "the options are in self.server.options (cf. make_server)"
+
+    def log_message(self, format, *args):
+        if self.server.options['verbose']:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_json(self, status, obj, headers = {}):
+        body = dumps(obj).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        options = self.server.options
+        t0 = time()
+
+        self.server.count('requests')
+
+        if (self.server.limiter is not None
+            and not self.server.limiter.allow()):
+            self.server.count('rate_limited')
+            self.send_json(429, {'error': 'too many requests'},
+                           {'Retry-After': '1'})
+            return
+
+        # simulated processing time
+        latency = options['latency'] + uniform(0, options['jitter'])
+        if latency > 0:
+            sleep(latency / 1000)
+
+        if random() < options['error_rate']:
+            self.server.count('errors')
+            self.send_json(500, {'error': 'simulated failure'})
+            return
+
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        terms = params.get('q[]', params.get('q', []))
+        if not len(terms):
+            self.send_json(400, {'error': 'missing q'})
+            return
+
+        took = int((time() - t0) * 1000)
+
+        # bad since/until/interval => 400 (not a dropped connection)
+        try:
+            if '/wos/' in url.path:
+                buckets = wos_histogram(terms, params)
+                total = sum(b['doc_count'] for b in buckets)
+                response = {
+                    'took': took, 'total': total,
+                    'aggs': {'publicationCount': {'buckets': buckets}},
+                    'hits': {'total': total, 'max_score': 0, 'hits': []}
+                }
+            elif len(terms) > 1 and options['split_batches']:
+                results = []
+                for term in terms:
+                    hits = twitter_histogram([term], params)
+                    results.append({'q': term, 'hits': hits, 'took': took,
+                                    'total': sum(h['doc_count'] for h in hits)})
+                response = {'results': results}
+            else:
+                hits = twitter_histogram(terms, params)
+                response = {'results': {
+                    'hits': hits, 'took': took,
+                    'total': sum(h['doc_count'] for h in hits)
+                }}
+        except ValueError as e:
+            self.send_json(400, {'error': 'bad parameters: %s' % e})
+            return
+
+        self.send_json(200, response)
+
+
+class MockHistogramServer(ThreadingHTTPServer):
+    # the default backlog (5) makes concurrent clients wait on SYN retries
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_server(port = DEFAULT_PORT, host = '127.0.0.1', latency = 0,
+                jitter = 0, error_rate = 0, rate_limit = 0,
+                split_batches = False, verbose = False):
+    """
+    A threading http server (not started: cf. serve_forever())
+
+    latency, jitter:  ms, the response time is latency + uniform(0, jitter)
+    error_rate:       fraction of requests answered by a 500
+    rate_limit:       max requests per second, beyond => 429 (0: no limit)
+    split_batches:    for twitter-like multi-term queries (q[]=a&q[]=b),
+                      return a list of per-term results instead of one
+                      summed histogram
+    """
+    server = MockHistogramServer((host, port), MockHistogramHandler)
+    server.options = {
+        'latency': latency,
+        'jitter': jitter,
+        'error_rate': error_rate,
+        'split_batches': split_batches,
+        'verbose': verbose
+    }
+    server.limiter = RateLimiter(rate_limit) if rate_limit > 0 else None
+
+    # stats
+    server.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0}
+    stats_lock = Lock()
+    def count(stat):
+        with stats_lock:
+            server.stats[stat] += 1
+    server.count = count
+
+    return server
+
+
+if __name__ == '__main__':
+    # cli args
+    # --------
+    parser = ArgumentParser(
+        description="Local stand-in for the iscpif histogram APIs (twitter-like and wos-like responses) with synthetic deterministic counts",
+        epilog="-----(© 2017 ISCPIF-CNRS romain.loth at iscpif dot fr )-----")
+
+    parser.add_argument('--port',
+        metavar='8765',
+        type=int,
+        default=DEFAULT_PORT,
+        help='port to listen on (default: %i)' % DEFAULT_PORT,
+        required=False,
+        action='store')
+
+    parser.add_argument('--latency',
+        metavar='ms',
+        type=float,
+        default=0,
+        help='fixed part of the response time',
+        required=False,
+        action='store')
+
+    parser.add_argument('--jitter',
+        metavar='ms',
+        type=float,
+        default=0,
+        help='random part of the response time (uniform from 0 to jitter)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--errorRate',
+        metavar='0.05',
+        type=float,
+        default=0,
+        help='fraction of requests answered with an HTTP 500',
+        required=False,
+        action='store')
+
+    parser.add_argument('--rateLimit',
+        metavar='req/s',
+        type=float,
+        default=0,
+        help='max requests per second, beyond that we answer 429 (default: no limit)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--splitBatches',
+        default=False,
+        help='answer multi-term twitter-like queries with separate results per term',
+        required=False,
+        action='store_true')
+
+    parser.add_argument('--verbose',
+        default=False,
+        help='log each request',
+        required=False,
+        action='store_true')
+
+    args = parser.parse_args(argv[1:])
+
+    server = make_server(args.port, latency=args.latency, jitter=args.jitter,
+                         error_rate=args.errorRate, rate_limit=args.rateLimit,
+                         split_batches=args.splitBatches, verbose=args.verbose)
+
+    print("mock histogram api on http://127.0.0.1:%i/ "
+          "(ex: /v2/pub/politic/france/twitter/histogram?q=climat "
+          "or /1/wos/search/histogram.json?q[]=climate)" % args.port,
+          file=stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("stats: %s" % server.stats, file=stderr)
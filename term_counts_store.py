@@ -0,0 +1,392 @@
+#! /usr/bin/python3
+"""
+Columnar store of the crawled histograms: one dense int32 matrix
+(terms x periods) in a memory-mapped .npy, with its index of terms
+(id, label) and its time axis
+
+A store is a dir with:
+  - counts.npy   the matrix, row = term, column = period
+  - terms.tsv    "id<tab>label" of each row
+  - store.json   {"granularity": "year", "periods": ["2000", ...], ...}
+
+Ingests the crawled json (both shapes, cf. many_json_buckets_to_one_table.py)
+and can append new terms or periods. Rows and period ranges are views
+on the memmap: nothing is read before it's used.
+"""
+__author__    = "Romain Loth"
+__copyright__ = "Copyright 2017 ISCPIF-CNRS"
+__license__   = "LGPL"
+__version__   = "1"
+__email__     = "romain.loth@iscpif.fr"
+__status__    = "dev"
+
+from argparse import ArgumentParser
+from sys      import argv, stderr, stdout
+from json     import load, dump
+from re       import sub
+from os       import path, makedirs, replace
+from datetime import datetime
+from calendar import timegm
+from bisect   import bisect_left, bisect_right
+from multiprocessing import Pool
+import numpy as np
+
+from many_json_buckets_to_one_table import (
+    GRANULARITIES, file_counts, term_id_of, sorted_by_term_id,
+    crawled_json_paths
+)
+from many_json_buckets_to_one_csv import label_of
+
+COUNTS_FILE = "counts.npy"
+TERMS_FILE = "terms.tsv"
+META_FILE = "store.json"
+
+# rows copied at a time when the matrix is resized
+PARAM_COPY_ROWS = 10000
+
+
+def lookup_key(label):
+    """
+    labels from file names and from queries compare equal
+    ex: 'Sea_level' and 'sea  level' => 'sea level'
+    """
+    return sub(r'[\W_]+', ' ', label.lower()).strip()
+
+
+def period_label(date_string, granularity):
+    "'2005' or '2005-03-01' => the period that contains it (ex: '2005-03')"
+    date = datetime.strptime((date_string + '-01-01')[:10], '%Y-%m-%d')
+    return date.strftime(GRANULARITIES[granularity])
+
+
+def write_atomic(file_path, write_fun):
+    "write_fun(fh) into a tmp file then rename it"
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        write_fun(fh)
+    replace(tmp_path, file_path)
+
+
+def store_entry(job):
+    """
+    (json_path, granularity) => (term_id, label, {period: count}) of a
+    crawled json, or None if it can't be read (for a worker process)
+    """
+    (json_path, granularity) = job
+    try:
+        counts = file_counts(json_path, granularity)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("WARNING: skipping %s (%s)" % (json_path, e), file=stderr)
+        return None
+    label = label_of(json_path)
+    term_id = term_id_of(json_path)
+    return (term_id if term_id is not None else label, label, counts)
+
+
+class TermCountsStore:
+    """
+    The store in store_dir (cf. create() for a new one)
+
+      - terms:       [(term_id, label)...] in row order
+      - row_of_id:   {term_id: row}
+      - row_of_key:  {lookup_key(label): row} (first row for a shared key)
+      - periods:     the sorted column periods, col_of_period: {period: col}
+      - counts:      the int32 memmap (read-only unless mode='r+')
+    """
+    def __init__(self, store_dir, mode = 'r'):
+        self.store_dir = store_dir
+        self.mode = mode
+
+        with open(path.join(store_dir, META_FILE)) as fh:
+            meta = load(fh)
+        self.granularity = meta['granularity']
+        self.periods = meta['periods']
+        self.col_of_period = {p: j for j, p in enumerate(self.periods)}
+
+        self.terms = []
+        with open(path.join(store_dir, TERMS_FILE)) as fh:
+            for line in fh:
+                (term_id, label) = line.rstrip('\n').split('\t')
+                self.terms.append((term_id, label))
+        self.index_terms()
+
+        self.counts = np.load(path.join(store_dir, COUNTS_FILE),
+                              mmap_mode=mode)
+        if self.counts.shape != (len(self.terms), len(self.periods)):
+            raise ValueError("inconsistent store %s: counts %s for %i terms "
+                             "and %i periods" % (store_dir, self.counts.shape,
+                                                 len(self.terms),
+                                                 len(self.periods)))
+
+    @classmethod
+    def create(cls, store_dir, granularity = 'year'):
+        "a new empty store (0 terms x 0 periods)"
+        makedirs(store_dir, exist_ok=True)
+        np.save(path.join(store_dir, COUNTS_FILE),
+                np.zeros((0, 0), dtype=np.int32))
+        write_atomic(path.join(store_dir, TERMS_FILE), lambda fh: None)
+        write_atomic(path.join(store_dir, META_FILE),
+                     lambda fh: dump({'granularity': granularity,
+                                      'periods': []}, fh))
+        return cls(store_dir, mode='r+')
+
+    def index_terms(self):
+        self.row_of_id = {}
+        self.row_of_key = {}
+        for row, (term_id, label) in enumerate(self.terms):
+            self.row_of_id[term_id] = row
+            self.row_of_key.setdefault(lookup_key(label), row)
+
+    def __len__(self):
+        return len(self.terms)
+
+    ##### O(1) access #####
+    def row(self, term, by_label = False):
+        """
+        the row of a term id or label (None if it isn't in the store)
+
+        by_label: only look at the labels (ex: for a node label "2012",
+                  which isn't the term of id 2012)
+        """
+        row = None
+        if not by_label:
+            row = self.row_of_id.get(term)
+        if row is None:
+            row = self.row_of_key.get(lookup_key(term))
+        return row
+
+    def columns(self, since = None, until = None):
+        "slice of the columns from since to until included (dates or periods)"
+        start = 0
+        stop = len(self.periods)
+        if since is not None:
+            since = period_label(since, self.granularity)
+            start = self.col_of_period.get(since)
+            if start is None:
+                start = bisect_left(self.periods, since)
+        if until is not None:
+            until = period_label(until, self.granularity)
+            stop = self.col_of_period.get(until)
+            if stop is None:
+                stop = bisect_right(self.periods, until)
+            else:
+                stop += 1
+        return slice(start, stop)
+
+    def series(self, term, since = None, until = None, by_label = False):
+        "the counts of one term (a view on the memmap) or None (cf. row)"
+        row = self.row(term, by_label)
+        if row is None:
+            return None
+        return self.counts[row, self.columns(since, until)]
+
+    def window(self, since = None, until = None):
+        "the counts of all terms over a period range (a view)"
+        return self.counts[:, self.columns(since, until)]
+
+    def hits(self, term, since = None, until = None, by_label = False):
+        """
+        the series of a term as api hits (cf. results.hits) or None
+        [{"key": epoch ms, "key_as_string": ..., "doc_count": n}...]
+        (the empty periods are skipped, like in the api)
+        """
+        counts = self.series(term, since, until, by_label)
+        if counts is None:
+            return None
+        cols = self.columns(since, until)
+        hits = []
+        for period, count in zip(self.periods[cols], counts.tolist()):
+            if count:
+                start = datetime.strptime((period + '-01-01')[:10],
+                                          '%Y-%m-%d')
+                hits.append({
+                    'key': timegm(start.timetuple()) * 1000,
+                    'key_as_string': start.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    'doc_count': count
+                })
+        return hits
+
+    ##### appends #####
+    def resize(self, new_terms, new_periods):
+        """
+        adds rows for new_terms [(term_id, label)...] and columns for
+        new_periods, in a new counts.npy (renamed over the old one)
+        """
+        periods = sorted(set(self.periods) | set(new_periods))
+        n_rows = len(self.terms) + len(new_terms)
+
+        counts_path = path.join(self.store_dir, COUNTS_FILE)
+        tmp_path = counts_path + '.tmp.npy'
+        resized = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                            dtype=np.int32,
+                                            shape=(n_rows, len(periods)))
+        if self.counts.size:
+            old_cols = np.searchsorted(periods, self.periods)
+            for i in range(0, len(self.terms), PARAM_COPY_ROWS):
+                block = self.counts[i:i+PARAM_COPY_ROWS]
+                resized[i:i+len(block), old_cols] = block
+        resized.flush()
+        del resized
+        replace(tmp_path, counts_path)
+
+        self.terms.extend(new_terms)
+        self.index_terms()
+        self.periods = periods
+        self.col_of_period = {p: j for j, p in enumerate(periods)}
+        self.counts = np.load(counts_path, mmap_mode='r+')
+        self.save_index()
+
+    def save_index(self):
+        write_atomic(path.join(self.store_dir, TERMS_FILE),
+                     lambda fh: fh.writelines("%s\t%s\n" % term
+                                              for term in self.terms))
+        write_atomic(path.join(self.store_dir, META_FILE),
+                     lambda fh: dump({'granularity': self.granularity,
+                                      'periods': self.periods,
+                                      'n_terms': len(self.terms)}, fh))
+
+    def ingest(self, json_paths, n_workers = None):
+        """
+        Adds (or refreshes) the crawled json histograms
+        (files parsed in parallel, one resize for all the new terms and
+         periods, then the counts are written in place)
+
+        NB a yearly store needs wos-like json, a monthly or daily one
+           needs json with epoch ms keys (cf. period_of)
+
+        returns (n ingested files, n new terms)
+        """
+        jobs = [(json_path, self.granularity)
+                  for json_path in sorted_by_term_id(json_paths)]
+        if n_workers == 1:
+            entries = [store_entry(job) for job in jobs]
+        else:
+            with Pool(n_workers) as pool:
+                entries = pool.map(store_entry, jobs, chunksize=64)
+        entries = [entry for entry in entries if entry is not None]
+
+        new_terms = []
+        new_ids = set()
+        new_periods = set()
+        for term_id, label, counts in entries:
+            if term_id not in self.row_of_id and term_id not in new_ids:
+                new_terms.append((term_id, label))
+                new_ids.add(term_id)
+            new_periods.update(p for p in counts
+                                 if p not in self.col_of_period)
+
+        if len(new_terms) or len(new_periods):
+            self.resize(new_terms, new_periods)
+
+        # a file replaces the periods it spans (the api skips the empty
+        # ones) and the other periods of the term are kept
+        for term_id, label, counts in entries:
+            if not len(counts):
+                continue
+            row = self.row_of_id[term_id]
+            cols = [self.col_of_period[p] for p in counts]
+            self.counts[row, min(cols):max(cols)+1] = 0
+            self.counts[row, cols] = list(counts.values())
+        self.counts.flush()
+
+        return (len(entries), len(new_terms))
+
+
+if __name__ == '__main__':
+    # cli args
+    # --------
+    parser = ArgumentParser(
+        description="Columnar store of the crawled histograms (int32 memmap terms x periods): ingest a dir of json, or print some terms and periods as a tsv",
+        epilog="-----(© 2017 ISCPIF-CNRS romain.loth at iscpif dot fr )-----")
+
+    parser.add_argument('-s',
+        metavar='pathto/storedir',
+        help='the store (created by the first --ingest)',
+        required=True,
+        action='store')
+
+    parser.add_argument('--ingest',
+        metavar='pathto/jsondir',
+        help='add or refresh the terms of this dir of crawled json (one per term, like 0042-some_term_.json)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--granularity',
+        choices=list(GRANULARITIES),
+        default='year',
+        help='period of the columns for a new store (default: year)',
+        required=False,
+        action='store')
+
+    parser.add_argument('-j',
+        metavar='n_workers',
+        type=int,
+        help='number of parallel processes to read the json files (default: as many as CPUs)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--term',
+        metavar='id_or_label',
+        help='print only these terms (repeatable, default: all)',
+        required=False,
+        action='append')
+
+    parser.add_argument('--since',
+        metavar='2000',
+        help='first period to print',
+        required=False,
+        action='store')
+
+    parser.add_argument('--until',
+        metavar='2015',
+        help='last period to print (included)',
+        required=False,
+        action='store')
+
+    parser.add_argument('--header',
+        default=False,
+        help='print a first line with the column names',
+        required=False,
+        action='store_true')
+
+    args = parser.parse_args(argv[1:])
+
+    if args.ingest:
+        json_paths = crawled_json_paths(args.ingest)
+        if not len(json_paths):
+            print("no files matching '*.json' were found under in directory '%s'"
+                    % args.ingest,
+                    file=stderr)
+            exit(1)
+
+        if path.exists(path.join(args.s, META_FILE)):
+            store = TermCountsStore(args.s, mode='r+')
+        else:
+            store = TermCountsStore.create(args.s, args.granularity)
+
+        (n_files, n_new) = store.ingest(json_paths, args.j)
+        print("ingested %i files (%i new terms): %i terms x %i periods"
+                % (n_files, n_new, len(store), len(store.periods)),
+                file=stderr)
+        exit(0)
+
+    store = TermCountsStore(args.s)
+
+    if args.term:
+        rows = []
+        for term in args.term:
+            row = store.row(term)
+            if row is None:
+                print("WARNING: '%s' isn't in the store" % term, file=stderr)
+            else:
+                rows.append(row)
+    else:
+        rows = range(len(store))
+
+    cols = store.columns(args.since, args.until)
+    if args.header:
+        print("\t".join(['id', 'label'] + store.periods[cols]))
+
+    for row in rows:
+        stdout.write("%s\t%s\t%s\n" % (store.terms[row][0], store.terms[row][1],
+                                        "\t".join(map(str, store.counts[row, cols]))))